@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Measure hashing throughput of the `diff_files` backends across file sizes.
+
+With --copy measure the copy engine instead, against `shutil.copyfile`, with the peak
+RSS and page cache growth seen during each copy.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sort import SortingPictures
+
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(size):
+    """Convert a size such as 100K or 4G into bytes.
+
+    :param size: Size string.
+    :return: int
+    """
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+
+def make_file(directory, size):
+    """Write a file of random data.
+
+    :param directory: Directory to write the file to.
+    :param size: Size of the file in bytes.
+    :return: Path of the new file.
+    """
+    path = Path(directory) / f"bench-{size}.bin"
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as out_file:
+        remaining = size
+        while remaining:
+            remaining -= out_file.write(block[: min(remaining, len(block))])
+    return path
+
+
+def hash_chunked(path, algorithm):
+    """The original 4096 byte `iter(lambda: ...)` loop, used as the baseline."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file_in:
+        for block in iter(lambda: file_in.read(4096), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_meminfo():
+    """Read the RSS of this process and the size of the page cache.
+
+    :return: (rss, cached) in bytes, None where /proc is not available.
+    """
+    values = dict()
+    for name, key in (("/proc/self/status", "VmRSS"), ("/proc/meminfo", "Cached")):
+        try:
+            with open(name) as in_file:
+                for line in in_file:
+                    if line.startswith(key + ":"):
+                        values[key] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return values.get("VmRSS"), values.get("Cached")
+
+
+def measure_copy(copy, size):
+    """Run one copy while sampling memory use.
+
+    :param copy: Function doing the copy.
+    :param size: Size of the copied file in bytes.
+    :return: (MB/s, peak RSS, page cache growth) with sizes in MB.
+    """
+    samples = [read_meminfo()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.1):
+            samples.append(read_meminfo())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.perf_counter()
+    copy()
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    samples.append(read_meminfo())
+
+    if samples[0][0] is None:
+        return size / elapsed / 1024**2, float("nan"), float("nan")
+    rss = max(x[0] for x in samples) / 1024**2
+    cached = (max(x[1] for x in samples) - samples[0][1]) / 1024**2
+    return size / elapsed / 1024**2, rss, cached
+
+
+def benchmark_copy(args, directory):
+    """Compare `shutil.copyfile` with the copy engine of `move_file`."""
+    sorting_pictures = SortingPictures()
+    backends = {
+        "shutil": shutil.copyfile,
+        "engine": sorting_pictures.copy_file,
+    }
+    print(f"{'size':>8} {'backend':>9} {'MB/s':>10} {'peak RSS':>10} {'cache +MB':>10}")
+    for size in args.sizes:
+        path = make_file(directory, parse_size(size))
+        dest = Path(directory) / "copy.bin"
+        for name, backend in backends.items():
+            # Start each copy with neither file in the page cache
+            with open(path, "rb") as file_in:
+                sorting_pictures.advise(file_in.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+            rate, rss, cached = measure_copy(
+                lambda: backend(path, dest), parse_size(size)
+            )
+            print(f"{size:>8} {name:>9} {rate:>10.1f} {rss:>10.1f} {cached:>10.1f}")
+            dest.unlink()
+        path.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", default="100K 10M 100M 1G".split())
+    parser.add_argument(
+        "--algorithms",
+        nargs="+",
+        default=sorted(SortingPictures.manifest_names),
+        choices=sorted(SortingPictures.manifest_names),
+    )
+    parser.add_argument("--dir", default=None, help="Directory for the test files.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--copy", action="store_true", help="Benchmark copying instead of hashing."
+    )
+    args = parser.parse_args()
+
+    sorting_pictures = SortingPictures()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        if args.copy:
+            benchmark_copy(args, directory)
+            return
+        print(f"{'size':>8} {'algorithm':>9} {'backend':>9} {'MB/s':>10}")
+        for size in args.sizes:
+            path = make_file(directory, parse_size(size))
+            for algorithm in args.algorithms:
+                sorting_pictures.hash_algorithm = algorithm
+                backends = {
+                    "chunked": lambda: hash_chunked(path, algorithm),
+                    "readinto": lambda: sorting_pictures.hash_file(path),
+                    "mmap": lambda: sorting_pictures.hash_file(path),
+                }
+                for name, backend in backends.items():
+                    sorting_pictures.mmap_threshold = 1 if name == "mmap" else 2**63
+                    backend()  # Warm the page cache
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        backend()
+                    elapsed = (time.perf_counter() - start) / args.repeat
+                    rate = parse_size(size) / elapsed / 1024**2
+                    print(f"{size:>8} {algorithm:>9} {name:>9} {rate:>10.1f}")
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
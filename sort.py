@@ -2,65 +2,1702 @@
 
 """Sort photos from the source directory into the destination directory."""
 import argparse
+import array
+import asyncio
+import contextlib
+import cProfile
+import errno
 import hashlib
+import hmac
+import http.client
+import io
+import itertools
 import json
+import math
+import mmap
+import os
+import pstats
+import queue
 import re
 import shutil
+import signal
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
-from datetime import datetime
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 from PIL import Image
 from PIL import UnidentifiedImageError
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from types import SimpleNamespace
+from xml.etree import ElementTree
 
 from tqdm import tqdm
 
+# Mode of new files under the umask, mkstemp only lets the owner read its files
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
 
-class SortingPictures:
-    date_replace = re.compile(r"[-~]")
-    date_pattern = re.compile(r"(\d{8}_\d{6})")
+
+class Archive:
+    """Read only access to the members of a zip or tar archive.
+
+    Tar members are indexed as the archive is read, a compressed tar has no
+    index and listing it up front would decompress all of it an extra time.
+    """
+
+    suffixes = (".zip", ".tar", ".tgz", ".tar.gz")
+    # Tar members up to this size are read once and kept in memory, so the
+    # header, hash and copy reads don't seek backwards in a compressed stream.
+    cache_size = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.cached = (None, b"")
+        # Large tar member whose start was read, (name, header, stream)
+        self.streamed = (None, b"", None)
+        # File members in the order their data is stored, and by name
+        self.order = list()
+        self.members = dict()
+        if zipfile.is_zipfile(self.path):
+            self.zip = zipfile.ZipFile(self.path)
+            self.tar = None
+            infos = [x for x in self.zip.infolist() if not x.is_dir()]
+            for info in sorted(infos, key=lambda x: x.header_offset):
+                self.add_member(info.filename, info)
+        else:
+            self.zip = None
+            self.tar = tarfile.open(self.path, "r:*")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @classmethod
+    def is_archive(cls, path):
+        """Check if a source path is an archive.
+
+        :param path: Path to check.
+        :return: True if it is a zip or tar archive, False otherwise.
+        """
+
+        path = Path(path)
+        return path.is_file() and path.name.lower().endswith(cls.suffixes)
+
+    def add_member(self, name, info):
+        # Tar member names may start with "./", use the same form as PurePosixPath
+        name = str(PurePosixPath(name))
+        if name not in self.members:
+            self.order.append(name)
+        self.members[name] = info
+
+    def index_next(self):
+        """Index the next tar member, reading on from the last one.
+
+        :return: False once the end of the archive is reached, True otherwise.
+        """
+
+        if self.tar is None:
+            return False
+        info = self.tar.next()
+        if info is None:
+            return False
+        if info.isfile():
+            self.add_member(info.name, info)
+        return True
+
+    def names(self):
+        """Iterate over the file members in the order their data is stored.
+
+        Tar members are indexed along the way, the next one is only read once the
+        caller is done with the one before.
+
+        :return: Iterator of member names.
+        """
+
+        position = 0
+        while position < len(self.order) or self.index_next():
+            if position < len(self.order):
+                yield self.order[position]
+                position += 1
+
+    def is_file(self, name):
+        """Check if the archive has a file member with this name.
+
+        Tar members not indexed yet are read up to the member, or the end.
+        """
+
+        name = str(name)
+        while name not in self.members:
+            if not self.index_next():
+                return False
+        return True
+
+    def size(self, name):
+        """Uncompressed size of a member."""
+        if self.tar is not None:
+            return self.members[name].size
+        return self.members[name].file_size
+
+    def mtime(self, name):
+        """Modification time of a member as a POSIX timestamp."""
+        if self.tar is not None:
+            return self.members[name].mtime
+        return datetime(*self.members[name].date_time).timestamp()
+
+    def open(self, name):
+        """Open a member for reading.
+
+        :param name: Member name.
+        :return: Binary file object.
+        """
+
+        name = str(name)
+        if self.zip is not None:
+            return self.zip.open(name)
+        if self.size(name) > self.cache_size:
+            streamed_name, header, stream = self.streamed
+            if streamed_name == name:
+                self.streamed = (None, b"", None)
+                return HeaderStream(header, stream)
+            return self.tar.extractfile(self.members[name])
+        if self.cached[0] != name:
+            self.cached = (name, self.tar.extractfile(self.members[name]).read())
+        return io.BytesIO(self.cached[1])
+
+    def read(self, name, size=-1):
+        """Read the start, or all, of a member.
+
+        Reading the start of a large tar member keeps its stream open, and the next
+        `open` of the member carries on from it. Opening the member again would seek
+        back, which makes a compressed tar decompress from the start of the archive.
+
+        :param name: Member name.
+        :param size: Number of bytes to read, -1 for everything.
+        :return: bytes
+        """
+
+        name = str(name)
+        if self.tar is None or size < 0 or self.size(name) <= self.cache_size:
+            with self.open(name) as file_in:
+                return file_in.read(size)
+        if self.streamed[2] is not None:
+            self.streamed[2].close()
+        stream = self.tar.extractfile(self.members[name])
+        header = stream.read(size)
+        self.streamed = (name, header, stream)
+        return header
+
+    def close(self):
+        """Close the archive."""
+        if self.streamed[2] is not None:
+            self.streamed[2].close()
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+
+class HeaderStream(io.RawIOBase):
+    """Binary stream giving bytes already read from a stream, then the rest of it."""
+
+    def __init__(self, header, stream):
+        self.header = memoryview(header)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.header:
+            count = min(len(buffer), len(self.header))
+            buffer[:count] = self.header[:count]
+            self.header = self.header[count:]
+            return count
+        return self.stream.readinto(buffer)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+class FileTable:
+    """Compact table of the files found by a scan.
+
+    Each directory is stored once and its files refer to it by number. Names are
+    packed one after the other into a single buffer, and sizes and mtimes into
+    arrays, so a file takes about 30 bytes plus the length of its name. A `Path`
+    is only built for a file when it is needed for I/O.
+    """
 
     def __init__(self):
-        self.log = dict()
-        for key in "parse suffix collisions exif google_json_date processed".split():
-            self.log[key] = list()
+        self.directories = list()
+        self.directory_ids = dict()
+        self.parents = array.array("I")
+        self.name_data = bytearray()
+        self.name_ends = array.array("Q")
+        self.sizes = array.array("Q")
+        self.mtimes = array.array("q")
 
-        self.ignore = set(".DS_Store .thumbnails".split())
+    def __len__(self):
+        return len(self.name_ends)
+
+    def add_directory(self, directory):
+        """Add a directory, or look up the number of one already added.
+
+        :param directory: Directory path string.
+        :return: int
+        """
+
+        directory_id = self.directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self.directory_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+        return directory_id
+
+    def add(self, parent, name, size, mtime):
+        """Add a file.
+
+        :param parent: Number of the file's directory, from `add_directory`.
+        :param name: File name.
+        :param size: Size in bytes.
+        :param mtime: Modification time in nanoseconds.
+        :return: Row of the file.
+        """
+
+        self.parents.append(parent)
+        self.name_data += os.fsencode(name)
+        self.name_ends.append(len(self.name_data))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        return len(self.name_ends) - 1
+
+    def name(self, row):
+        """Get the name of a file.
+
+        :param row: Row of the file.
+        :return: str
+        """
+
+        start = self.name_ends[row - 1] if row else 0
+        return os.fsdecode(bytes(self.name_data[start : self.name_ends[row]]))
+
+    def path(self, row):
+        """Build the path of a file.
+
+        :param row: Row of the file.
+        :return: Path
+        """
+
+        return Path(self.directories[self.parents[row]], self.name(row))
+
+    def suffix(self, row):
+        """Get the suffix of a file the way `Path.suffix` does, without a `Path`.
+
+        :param row: Row of the file.
+        :return: str
+        """
+
+        name = self.name(row)
+        i = name.rfind(".")
+        if 0 < i < len(name) - 1:
+            return name[i:]
+        return ""
+
+
+class RuleSet:
+    """Gitignore style include and exclude rules compiled into one regular expression.
+
+    Rules are matched against paths relative to the source and the last rule that
+    matches wins. A rule starting with `!` includes what an earlier rule excluded,
+    one ending with `/` only matches directories, and one with a `/` anywhere else
+    is anchored to the source instead of matching at any depth. `*` and `?` don't
+    match `/`, `**` does, and a backslash escapes the next character, as in `\\#recycle/`.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list()
+        self.matchers = None
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """Add a rule after the existing ones.
+
+        :param rule: Rule, blank lines and lines starting with # are skipped.
+        :return: None
+        """
+
+        pattern = rule.strip()
+        if not pattern or pattern.startswith("#"):
+            return
+        include = pattern.startswith("!")
+        pattern = pattern[1:] if include else pattern
+        directory_only = pattern.endswith("/")
+        self.rules.append((rule.strip(), include, directory_only, pattern.rstrip("/")))
+        self.matchers = None
 
     @staticmethod
-    def parse_arguments():
-        """Parse command line arguments."""
+    def translate(pattern):
+        """Turn a rule's pattern into a regular expression.
 
-        parser = argparse.ArgumentParser(
-            description="""Sort image files based on filename timestamp into year-month folders.
-            Do not use --exif and --google-json together!"""
-        )
-        parser.add_argument(
-            "--move",
-            action="store_true",
-            required=False,
-            default=False,
-            help="Move files instead of copying them (default action is to copy).",
-        )
-        parser.add_argument(
-            "--collisions",
-            action="store_true",
-            required=False,
-            default=False,
-            help="Print out source and destination files with collisions.",
-        )
-        parser.add_argument(
-            "--suffix",
-            action="store_true",
-            required=False,
-            default=False,
-            help="Print out source files with unknown suffixes (extension).",
+        :param pattern: Pattern without the leading ! or trailing /.
+        :return: str
+        """
+
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "\\" and i + 1 < len(pattern):
+                regex += re.escape(pattern[i + 1])
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+                end = pattern.index("]", i + 2)
+                chars = pattern[i + 1 : end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[" + chars.replace("\\", "\\\\") + "]"
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        return regex
+
+    def compile(self):
+        """Compile the rules into one expression for files and one for directories.
+
+        The rules are joined last first, each in its own group, so the group that
+        matched tells which rule wins.
+
+        :return: None
+        """
+
+        self.matchers = dict()
+        for directory in False, True:
+            groups = list()
+            parts = list()
+            for index in reversed(range(len(self.rules))):
+                if self.rules[index][2] and not directory:
+                    continue
+                groups.append(index)
+                parts.append("(%s)" % self.translate(self.rules[index][3]))
+            regex = re.compile("|".join(parts)) if parts else None
+            self.matchers[directory] = (regex, groups)
+
+    def match(self, path, directory=False):
+        """Find the rule that decides a path.
+
+        :param path: Path relative to the source, with / separators.
+        :param directory: True if the path is a directory.
+        :return: tuple of the rule and True if it includes the path, None if no rule matches.
+        """
+
+        if self.matchers is None:
+            self.compile()
+        regex, groups = self.matchers[directory]
+        if regex is None:
+            return None
+        match = regex.fullmatch(path)
+        if match is None:
+            return None
+        rule = self.rules[groups[match.lastindex - 1]]
+        return rule[0], rule[1]
+
+
+class TokenBucket:
+    """Thread safe token bucket used to limit a rate, such as bytes per second.
+
+    A rate of None leaves the bucket unlimited.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Change the rate, for example while a run is going.
+
+        :param rate: New rate, None for no limit.
+        :return: None
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if not self.rate:
+                self.tokens = rate or 0
+            elif rate:
+                tokens = self.tokens + (now - self.updated) * self.rate
+                self.tokens = min(rate, tokens)
+            self.rate = rate
+            self.updated = now
+
+    def consume(self, amount):
+        """Take tokens from the bucket, sleeping until the rate allows it.
+
+        :param amount: Number of tokens, for example bytes read.
+        :return: None
+        """
+
+        if not self.rate:
+            return
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class LimitedReader(io.RawIOBase):
+    """Binary stream taking tokens from a `TokenBucket` for each read of another one.
+
+    Uploads read their data as they send it, so limiting the reads paces the
+    upload instead of sleeping for the whole file before it.
+    """
+
+    def __init__(self, stream, bucket):
+        self.stream = stream
+        self.bucket = bucket
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        if count:
+            self.bucket.consume(count)
+        return count
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+
+class Autotuner:
+    """Thread safe hill climbing controller for the number of workers of a stage.
+
+    Work is measured in windows of at least `window` seconds. After each window the
+    worker count takes a step in the current direction while the throughput goes up,
+    and turns back when it drops. When the throughput stays level but the latency
+    rises the device is only queueing the extra work, so a worker is taken away.
+    """
+
+    # Changes in throughput smaller than this are treated as level
+    tolerance = 0.05
+
+    def __init__(self, name, low, high, window=2.0):
+        self.name = name
+        self.low = low
+        self.high = high
+        self.window = window
+        self.workers = low
+        self.direction = 1
+        self.active = 0
+        self.condition = threading.Condition()
+        self.previous = None
+        self.decisions = list()
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.started = now
+        self.items = 0
+        self.units = 0
+        self.latency = 0.0
+
+    @contextlib.contextmanager
+    def slot(self, units=1):
+        """Run the body of a `with` block as one of the stage's workers.
+
+        Waits while the stage already has `workers` items going, then records the
+        time the body took.
+
+        :param units: Amount of work done by the body, for example bytes.
+        :return: Context manager.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.workers)
+            self.active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            with self.condition:
+                self.active -= 1
+                self.items += 1
+                self.units += units
+                self.latency += now - start
+                if now - self.started >= self.window and self.items >= self.workers:
+                    self.adjust(now)
+                self.condition.notify_all()
+
+    def adjust(self, now):
+        """Take one hill climbing step from the measurements of the last window.
+
+        :param now: time.monotonic() at the end of the window.
+        :return: None
+        """
+
+        rate = self.units / (now - self.started)
+        latency = self.latency / self.items
+        step = self.direction
+        if self.previous is not None:
+            previous_rate, previous_latency = self.previous
+            if rate < previous_rate * (1 - self.tolerance):
+                step = self.direction = -self.direction
+            elif rate <= previous_rate * (
+                1 + self.tolerance
+            ) and latency > previous_latency * (1 + self.tolerance):
+                step = self.direction = -1
+        if not self.low <= self.workers + step <= self.high:
+            step = self.direction = -step
+        workers = min(self.high, max(self.low, self.workers + step))
+        if workers != self.workers:
+            self.decisions.append((self.workers, workers, rate, latency))
+            self.workers = workers
+        self.previous = (rate, latency)
+        self.reset(now)
+
+
+class Tracer:
+    """Collect trace events in the Chrome trace format, for Perfetto or chrome://tracing."""
+
+    def __init__(self):
+        self.events = list()
+        self.threads = set()
+
+    @contextlib.contextmanager
+    def span(self, name, category, path=None, **args):
+        """Record the time taken by the body of a `with` block.
+
+        :param name: Name of the span.
+        :param category: Category of the span, for example "hash".
+        :param path: File the span works on, its size and suffix are added to the args.
+        :param args: Other values to show with the span.
+        :return: Context manager giving the args, which can still be added to.
+        """
+
+        if path is not None:
+            args.update(path=str(path), suffix=Path(path).suffix.lower())
+            try:
+                args.setdefault("size", os.stat(path).st_size)
+            except OSError:
+                pass
+
+        pid, tid = os.getpid(), threading.get_native_id()
+        if (pid, tid) not in self.threads:
+            self.threads.add((pid, tid))
+            self.events.append(
+                dict(
+                    name="thread_name",
+                    ph="M",
+                    pid=pid,
+                    tid=tid,
+                    args=dict(name=threading.current_thread().name),
+                )
+            )
+
+        start = time.monotonic_ns()
+        try:
+            yield args
+        finally:
+            self.events.append(
+                dict(
+                    name=name,
+                    cat=category,
+                    ph="X",
+                    ts=start / 1000,
+                    dur=(time.monotonic_ns() - start) / 1000,
+                    pid=pid,
+                    tid=tid,
+                    args=args,
+                )
+            )
+
+    def write(self, trace):
+        """Write the events to a JSON trace file.
+
+        :param trace: Path of the trace file.
+        :return: None
+        """
+
+        with open(trace, "w") as out_file:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"), out_file)
+
+
+class Profiler:
+    """cProfile of the main thread, worker threads and worker processes, merged
+    into one pstats file."""
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self.process_stats = list()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start profiling the calling thread."""
+        self.local.active = True
+        self.profiles[0].enable()
+
+    def stop(self):
+        """Stop profiling the thread that called `start`."""
+        self.profiles[0].disable()
+        self.local.active = False
+
+    def wrap(self, function):
+        """Wrap a function run on a worker thread so it gets profiled.
+
+        :param function: Function to wrap.
+        :return: The wrapped function.
+        """
+
+        def profiled(*args):
+            if getattr(self.local, "active", False):
+                return function(*args)
+
+            profile = getattr(self.local, "profile", None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(profile)
+            try:
+                profile.enable()
+            except ValueError:
+                # Profiling isn't per thread, the main profile already sees this call
+                return function(*args)
+            self.local.active = True
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+                self.local.active = False
+
+        return profiled
+
+    def write(self, profile):
+        """Merge the profiles and write them to a pstats file.
+
+        :param profile: Path of the pstats file.
+        :return: None
+        """
+
+        stats = pstats.Stats(self.profiles[0])
+        for item in self.profiles[1:]:
+            stats.add(item)
+        for item in self.process_stats:
+            stats.add(SimpleNamespace(stats=item, create_stats=lambda: None))
+        stats.dump_stats(profile)
+
+
+def run_in_worker(function, args, trace=False, profile=False):
+    """Run a function on a worker process, tracing or profiling it if asked.
+
+    :param function: Function to run.
+    :param args: Arguments for the function.
+    :param trace: True to collect trace events.
+    :param profile: True to profile the call.
+    :return: tuple of the result, the trace events and the profile stats.
+    """
+
+    tracer = Tracer() if trace else None
+    profiler = cProfile.Profile() if profile else None
+
+    with contextlib.ExitStack() as stack:
+        if tracer is not None:
+            stack.enter_context(tracer.span(function.__name__, "worker"))
+        if profiler is not None:
+            profiler.enable()
+            stack.callback(profiler.disable)
+        result = function(*args)
+
+    stats = None
+    if profiler is not None:
+        profiler.create_stats()
+        stats = profiler.stats
+    return result, tracer.events if tracer is not None else list(), stats
+
+
+class Watchdog:
+    """Run calls on a worker thread and give up on them after a time limit.
+
+    A call that runs over the limit is abandoned along with its worker thread and
+    a new worker takes over. Workers are daemon threads, so an abandoned one can't
+    hold up the exit of the program.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.requests = None
+
+    @staticmethod
+    def work(requests):
+        """Run calls from a queue until it hands over None."""
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            function, args, future = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def call(self, function, *args):
+        """Call a function on the worker.
+
+        :param function: Function to call.
+        :param args: Arguments for the function.
+        :return: Whatever the function returns.
+        :raises TimeoutError: If the function didn't return in time.
+        """
+
+        if not self.timeout:
+            return function(*args)
+
+        if self.requests is None:
+            self.requests = queue.Queue()
+            worker = threading.Thread(target=self.work, args=(self.requests,))
+            worker.daemon = True
+            worker.start()
+
+        future = Future()
+        self.requests.put((function, args, future))
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            # The stuck worker stops once it is free, the next call starts a new one
+            self.requests.put(None)
+            self.requests = None
+            raise TimeoutError(f"{function} took more than {self.timeout}s")
+
+
+class Prefetcher:
+    """Read the start of files and look up files ahead of use, many at a time.
+
+    An asyncio event loop on a thread of its own keeps up to `limit` requests in
+    flight. Each blocking read or stat runs on a thread of the loop's executor, on
+    network mounts they spend nearly all their time waiting on the server.
+    """
+
+    def __init__(self, limit, size):
+        self.size = size
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=limit)
+        self.loop.set_default_executor(self.executor)
+        self.semaphore = asyncio.Semaphore(limit)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def read(self, path):
+        try:
+            with open(path, "rb") as in_file:
+                return in_file.read(self.size)
+        except OSError:
+            return None
+
+    async def run(self, function, path):
+        async with self.semaphore:
+            return await self.loop.run_in_executor(None, function, path)
+
+    def header(self, path):
+        """Start reading the first `size` bytes of a file.
+
+        :param path: File to read.
+        :return: concurrent.futures.Future of the bytes, None if they couldn't be read.
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.run(self.read, path), self.loop)
+
+    def is_file(self, path):
+        """Start checking whether a path is a file.
+
+        :param path: Path to check.
+        :return: concurrent.futures.Future of a bool.
+        """
+
+        return asyncio.run_coroutine_threadsafe(
+            self.run(os.path.isfile, path), self.loop
         )
-        parser.add_argument(
-            "--parse",
-            action="store_true",
-            required=False,
-            default=False,
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(cancel_futures=True)
+        self.loop.close()
+
+
+def make_thumbnail(src_file, thumbnail, size):
+    """Write a JPEG preview of an image, run on a process pool.
+
+    JPEG files are decoded at a reduced resolution with `Image.draft`, which is
+    much faster than decoding the full image. The preview gets the mtime of the
+    image, so it can be told apart from an out of date one.
+
+    :param src_file: Image file.
+    :param thumbnail: Path of the preview.
+    :param size: Largest width and height of the preview.
+    :return: True if the preview was written, False if the image couldn't be read
+        or is larger than Pillow is willing to decode.
+    """
+
+    thumbnail = Path(thumbnail)
+    try:
+        with Image.open(src_file) as img:
+            img.draft("RGB", (size, size))
+            img.thumbnail((size, size))
+            preview = img.convert("RGB")
+    except (
+        UnidentifiedImageError,
+        Image.DecompressionBombError,
+        OSError,
+        ValueError,
+        SyntaxError,
+        EOFError,
+        struct.error,
+    ):
+        return False
+
+    thumbnail.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(
+        prefix=f".{thumbnail.name}.", suffix=".part", dir=thumbnail.parent
+    )
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, "wb") as out_file:
+            preview.save(out_file, "JPEG", quality=85)
+        mtime = os.stat(src_file).st_mtime_ns
+        os.utime(temp, ns=(mtime, mtime))
+        os.replace(temp, thumbnail)
+    except BaseException:
+        Path(temp).unlink(missing_ok=True)
+        raise
+    return True
+
+
+class ObjectStorage:
+    """Destination storage in a bucket of an S3 compatible object store.
+
+    Requests are signed with AWS signature version 4 and sent over a pool of kept
+    alive connections. Files bigger than `part_size` are uploaded in parts on a
+    pool of `workers` threads. Objects are only ever created with `If-None-Match: *`
+    so a key that is taken is never overwritten.
+    """
+
+    algorithm = "AWS4-HMAC-SHA256"
+    # Characters that aren't percent encoded in keys and query strings
+    unreserved = "-_.~"
+
+    def __init__(
+        self,
+        endpoint,
+        bucket,
+        prefix="",
+        access_key=None,
+        secret_key=None,
+        region="us-east-1",
+        part_size=8 * 1024**2,
+        workers=4,
+    ):
+        endpoint = urllib.parse.urlsplit(endpoint)
+        self.secure = endpoint.scheme == "https"
+        self.host = endpoint.netloc
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.part_size = part_size
+        self.workers = workers
+        self.connections = queue.LifoQueue()
+        self.pool = None
+
+    @classmethod
+    def from_url(cls, url, endpoint=None, **kwargs):
+        """Make the storage for an s3://bucket/prefix URL.
+
+        Credentials and the region are taken from the usual AWS environment
+        variables.
+
+        :param url: s3:// URL of the destination.
+        :param endpoint: URL of the object store, None for AWS_ENDPOINT_URL or AWS S3.
+        :return: ObjectStorage
+        """
+
+        url = urllib.parse.urlsplit(url)
+        region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION"))
+        region = region or "us-east-1"
+        endpoint = endpoint or os.environ.get("AWS_ENDPOINT_URL")
+        return cls(
+            endpoint or f"https://s3.{region}.amazonaws.com",
+            url.netloc,
+            url.path,
+            os.environ.get("AWS_ACCESS_KEY_ID"),
+            os.environ.get("AWS_SECRET_ACCESS_KEY"),
+            region,
+            **kwargs,
+        )
+
+    @classmethod
+    def quote(cls, value, safe=""):
+        return urllib.parse.quote(value, safe=cls.unreserved + safe)
+
+    @classmethod
+    def query_string(cls, query):
+        return "&".join(
+            f"{cls.quote(k)}={cls.quote(str(v))}" for k, v in sorted(query.items())
+        )
+
+    def sign(self, method, path, query, headers, payload_hash, now=None):
+        """Add an AWS signature version 4 Authorization header to a request.
+
+        :param method: HTTP method.
+        :param path: Request path, already percent encoded.
+        :param query: dict of query parameters.
+        :param headers: dict of lower case header names to values, all of them are signed.
+        :param payload_hash: Hex SHA-256 of the request body.
+        :param now: Time of the request, None for now.
+        :return: None
+        """
+
+        now = now or datetime.now(timezone.utc)
+        headers.setdefault("x-amz-date", now.strftime("%Y%m%dT%H%M%SZ"))
+        headers.setdefault("x-amz-content-sha256", payload_hash)
+        date = headers["x-amz-date"][:8]
+
+        names = sorted(headers)
+        canonical = "\n".join(
+            [
+                method,
+                path,
+                self.query_string(query),
+                "".join(f"{x}:{str(headers[x]).strip()}\n" for x in names),
+                ";".join(names),
+                payload_hash,
+            ]
+        )
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            [
+                self.algorithm,
+                headers["x-amz-date"],
+                scope,
+                hashlib.sha256(canonical.encode()).hexdigest(),
+            ]
+        )
+
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"{self.algorithm} Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(names)}, Signature={signature}"
+        )
+
+    def connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=60)
+        return http.client.HTTPConnection(self.host, timeout=60)
+
+    def prepare(self, method, key, query, headers, body):
+        """Build the path and signed headers of a request.
+
+        :return: tuple of the URL path with the query string and the headers.
+        """
+
+        path = "/" + self.quote(self.bucket)
+        if key is not None:
+            path += "/" + self.quote(self.prefix + key, "/")
+        query = query or dict()
+        headers = {k.lower(): v for k, v in (headers or dict()).items()}
+        headers["host"] = self.host
+        payload_hash = hashlib.sha256(body).hexdigest()
+        if self.access_key:
+            self.sign(method, path, query, headers, payload_hash)
+        else:
+            headers["x-amz-content-sha256"] = payload_hash
+        if query:
+            path += "?" + self.query_string(query)
+        return path, headers
+
+    def request(self, method, key=None, query=None, headers=None, body=b""):
+        """Send a request on a pooled connection.
+
+        A connection the server has closed while it was idle is replaced once.
+
+        :param method: HTTP method.
+        :param key: Object key below the prefix, None for the bucket.
+        :param query: dict of query parameters.
+        :param headers: dict of extra headers.
+        :param body: Request body.
+        :return: tuple of the status, the response headers and the response body.
+        """
+
+        path, headers = self.prepare(method, key, query, headers, body)
+        for attempt in range(2):
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.connect()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            self.connections.put(connection)
+            return response.status, response.headers, data
+
+    @staticmethod
+    def find(root, name):
+        """Find the elements of a response document with a tag, whatever its namespace."""
+        return [x for x in root.iter() if x.tag.rsplit("}", 1)[-1] == name]
+
+    @classmethod
+    def findtext(cls, root, name):
+        elements = cls.find(root, name)
+        return elements[0].text if elements else None
+
+    def check(self, method, key, status, data, *expected):
+        """Raise an error for an unexpected response.
+
+        Some requests fail with a 200 status and an error document.
+
+        :return: True for an expected status, False if the key was already taken.
+        """
+
+        error = None
+        if data.lstrip().startswith(b"<"):
+            root = ElementTree.fromstring(data)
+            if root.tag.rsplit("}", 1)[-1] == "Error":
+                error = self.findtext(root, "Code")
+        if status == 412 or status == 409 or error == "PreconditionFailed":
+            return False
+        if status not in expected or error is not None:
+            raise OSError(f"{method} {self.prefix}{key} failed: {status} {error}")
+        return True
+
+    def stat(self, key):
+        """Look up a stored object.
+
+        :param key: Key of the object.
+        :return: SimpleNamespace with size and metadata, None if there's no object.
+        """
+
+        status, headers, data = self.request("HEAD", key)
+        if status == 404:
+            return None
+        self.check("HEAD", key, status, data, 200)
+        metadata = {
+            name[11:].lower(): value
+            for name, value in headers.items()
+            if name.lower().startswith("x-amz-meta-")
+        }
+        return SimpleNamespace(size=int(headers["Content-Length"]), metadata=metadata)
+
+    def open(self, key):
+        """Read a stored object.
+
+        The response is streamed on a connection of its own.
+
+        :param key: Key of the object.
+        :return: Binary file object.
+        """
+
+        path, headers = self.prepare("GET", key, None, None, b"")
+        connection = self.connect()
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        if response.status == 404:
+            connection.close()
+            raise FileNotFoundError(self.prefix + key)
+        if response.status != 200:
+            self.check("GET", key, response.status, response.read(), 200)
+        return response
+
+    def put(self, key, file_in, size=None, metadata=None):
+        """Store the data of a file object under a key, unless the key is taken.
+
+        :param key: Key to store the data under.
+        :param file_in: Binary file object to read the data from.
+        :param size: Number of bytes, None if not known.
+        :param metadata: dict of metadata to store with the object.
+        :return: True if stored, False if the key was already taken.
+        """
+
+        headers = {"if-none-match": "*"}
+        for name, value in (metadata or dict()).items():
+            headers["x-amz-meta-" + name] = value
+        if size is not None and size <= self.part_size:
+            body = file_in.read()
+            status, _, data = self.request("PUT", key, headers=headers, body=body)
+            return self.check("PUT", key, status, data, 200)
+        return self.put_multipart(key, file_in, headers)
+
+    def put_multipart(self, key, file_in, headers):
+        """Upload a file in parts, several parts at a time.
+
+        At most `workers` parts are read ahead of the uploads so memory use stays
+        bounded. The upload is aborted if it fails or the key is taken.
+
+        :return: True if stored, False if the key was already taken.
+        """
+
+        conditions = {"if-none-match": headers.pop("if-none-match")}
+        status, _, data = self.request("POST", key, {"uploads": ""}, headers)
+        self.check("POST", key, status, data, 200)
+        upload_id = self.findtext(ElementTree.fromstring(data), "UploadId")
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        def upload_part(number, body):
+            query = {"partNumber": number, "uploadId": upload_id}
+            status, headers, data = self.request("PUT", key, query, body=body)
+            self.check("PUT", key, status, data, 200)
+            return headers["ETag"]
+
+        stored = False
+        parts = list()
+        try:
+            while True:
+                body = file_in.read(self.part_size)
+                if not body and parts:
+                    break
+                if len(parts) >= self.workers:
+                    parts[-self.workers].result()
+                parts.append(self.pool.submit(upload_part, len(parts) + 1, body))
+                if not body:
+                    break
+
+            document = "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{part.result()}</ETag></Part>"
+                for number, part in enumerate(parts, 1)
+            )
+            document = f"<CompleteMultipartUpload>{document}</CompleteMultipartUpload>"
+            query = {"uploadId": upload_id}
+            status, _, data = self.request(
+                "POST", key, query, conditions, document.encode()
+            )
+            stored = self.check("POST", key, status, data, 200)
+            return stored
+        finally:
+            if not stored:
+                for part in parts:
+                    part.cancel()
+                self.request("DELETE", key, {"uploadId": upload_id})
+
+
+class Catalog:
+    """SQLite catalog of the files in a sorted library.
+
+    Paths are stored relative to the library. Rows queued with `add` are written
+    in one transaction by `commit`, alongside the batches of synced copies.
+    """
+
+    name = ".catalog.sqlite"
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            taken TEXT,
+            prefix TEXT,
+            suffix TEXT,
+            size INTEGER,
+            mtime INTEGER,
+            algorithm TEXT,
+            hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_taken ON files (taken, prefix, size);
+        CREATE INDEX IF NOT EXISTS files_kind ON files (prefix, suffix);
+        CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+    """
+    # A hash is kept when a row is rewritten without one while the file is unchanged
+    upsert = """
+        INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET
+            taken = excluded.taken,
+            prefix = excluded.prefix,
+            suffix = excluded.suffix,
+            size = excluded.size,
+            mtime = excluded.mtime,
+            algorithm = coalesce(excluded.algorithm, CASE
+                WHEN size = excluded.size AND mtime = excluded.mtime THEN algorithm END),
+            hash = coalesce(excluded.hash, CASE
+                WHEN size = excluded.size AND mtime = excluded.mtime THEN hash END)
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.created = not (self.root / self.name).exists()
+        self.connection = sqlite3.connect(
+            self.root / self.name, check_same_thread=False
+        )
+        self.connection.executescript(self.schema)
+        self.rows = dict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def key(self, path):
+        return Path(path).relative_to(self.root).as_posix()
+
+    def add(self, path, taken, size, mtime, algorithm=None, digest=None):
+        """Queue a file to be written by the next `commit`.
+
+        :param path: Path of the file in the library.
+        :param taken: Timestamp of the file, None if not known.
+        :param size: Size in bytes.
+        :param mtime: mtime in ns.
+        :param algorithm: Hash algorithm of digest.
+        :param digest: Hex digest of the file, None if not known.
+        :return: None
+        """
+
+        name = Path(path).name
+        row = (
+            self.key(path),
+            None if taken is None else taken.isoformat(" "),
+            name[:4] if name[:4] in ("IMG_", "VID_") else None,
+            Path(name).suffix.lower(),
+            size,
+            mtime,
+            algorithm if digest is not None else None,
+            digest,
+        )
+        with self.lock:
+            queued = self.rows.get(row[0])
+            if digest is None and queued is not None and queued[4:6] == row[4:6]:
+                row = queued
+            self.rows[row[0]] = row
+
+    def commit(self):
+        """Write the queued rows in one transaction.
+
+        :return: None
+        """
+
+        with self.lock:
+            if not self.rows:
+                return
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM files WHERE path = ?",
+                    [(k,) for k, v in self.rows.items() if v is None],
+                )
+                self.connection.executemany(
+                    self.upsert, [x for x in self.rows.values() if x is not None]
+                )
+            self.rows = dict()
+
+    def remove(self, path):
+        """Queue a file to be removed by the next `commit`.
+
+        :param path: Path of the file in the library.
+        :return: None
+        """
+
+        with self.lock:
+            self.rows[self.key(path)] = None
+
+    def lookup(self, path):
+        """Get the stored size, mtime, hash algorithm and hash of a file.
+
+        :param path: Path of the file in the library.
+        :return: tuple, None if the file isn't in the catalog.
+        """
+
+        key = self.key(path)
+        with self.lock:
+            if key in self.rows:
+                return None if self.rows[key] is None else self.rows[key][4:]
+            return self.connection.execute(
+                "SELECT size, mtime, algorithm, hash FROM files WHERE path = ?", (key,)
+            ).fetchone()
+
+    def between(self, start, end):
+        """Get the files taken in a time range.
+
+        :param start: Start of the range.
+        :param end: End of the range, not included.
+        :return: list of (path, taken, size) in time order.
+        """
+
+        return self.connection.execute(
+            "SELECT path, taken, size FROM files WHERE taken >= ? AND taken < ?"
+            " ORDER BY taken, path",
+            (start.isoformat(" "), end.isoformat(" ")),
+        ).fetchall()
+
+    def months(self):
+        """Count the images and videos of each month and their bytes.
+
+        :return: list of (month, images, videos, bytes) in month order.
+        """
+
+        return self.connection.execute(
+            "SELECT substr(taken, 1, 7), sum(prefix = 'IMG_'), sum(prefix = 'VID_'),"
+            " sum(size) FROM files WHERE taken IS NOT NULL"
+            " GROUP BY substr(taken, 1, 7) ORDER BY 1"
+        ).fetchall()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class BloomFilter:
+    """Set membership test with no false negatives and a bounded false positive rate.
+
+    Items are hashes already, so the bit positions are taken from their bytes by
+    double hashing instead of hashing them again.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(
+            64, int(-capacity * math.log(error_rate) / math.log(2) ** 2) // 8 * 8
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8)
+
+    def positions(self, item):
+        first = int.from_bytes(item[:8], "little")
+        second = int.from_bytes(item[8:16], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(item)
+        )
+
+
+class Ledger:
+    """SQLite ledger of the source files already imported, keyed by fingerprint.
+
+    A Bloom filter of every fingerprint is kept in memory, so files that were never
+    imported are answered without a query. Rows queued with `add` are written by
+    `commit`, once their copies are durable.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS imports (
+            fingerprint BLOB PRIMARY KEY,
+            size INTEGER,
+            source TEXT,
+            imported TEXT
+        ) WITHOUT ROWID;
+    """
+    # Bytes hashed at each end of a file
+    sample_size = 64 * 1024
+
+    def __init__(self, path, error_rate=0.01):
+        self.path = os.path.abspath(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(self.schema)
+        self.lock = threading.Lock()
+        self.rows = dict()
+        count = self.connection.execute("SELECT count(*) FROM imports").fetchone()[0]
+        # Room for the imports of a few more runs before false positives go up
+        self.bloom = BloomFilter(max(2 * count, 100000), error_rate)
+        for (fingerprint,) in self.connection.execute(
+            "SELECT fingerprint FROM imports"
+        ):
+            self.bloom.add(fingerprint)
+        self.false_positives = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def fingerprint(cls, path):
+        """Fingerprint a file from its size and the hash of its first and last bytes.
+
+        :param path: File to fingerprint.
+        :return: (16 byte fingerprint, size), (None, None) if the file can't be read.
+        """
+
+        try:
+            with open(path, "rb") as in_file:
+                size = os.fstat(in_file.fileno()).st_size
+                digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+                digest.update(in_file.read(cls.sample_size))
+                if size > 2 * cls.sample_size:
+                    in_file.seek(size - cls.sample_size)
+                digest.update(in_file.read(cls.sample_size))
+        except OSError:
+            return None, None
+        return digest.digest(), size
+
+    def __contains__(self, fingerprint):
+        if fingerprint is None or fingerprint not in self.bloom:
+            return False
+        with self.lock:
+            if fingerprint in self.rows:
+                return True
+            found = self.connection.execute(
+                "SELECT 1 FROM imports WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if found is None:
+                self.false_positives += 1
+        return found is not None
+
+    def add(self, fingerprint, size, source):
+        """Queue an imported file to be written by the next `commit`.
+
+        :param fingerprint: Fingerprint of the file.
+        :param size: Size in bytes.
+        :param source: Path it was imported from.
+        :return: None
+        """
+
+        with self.lock:
+            self.rows[fingerprint] = (
+                fingerprint,
+                size,
+                str(source),
+                datetime.now().isoformat(" ", "seconds"),
+            )
+            self.bloom.add(fingerprint)
+
+    def commit(self):
+        with self.lock:
+            if not self.rows:
+                return
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?)",
+                    list(self.rows.values()),
+                )
+            self.rows = dict()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class SortingPictures:
+    date_replace = re.compile(r"[-~]")
+    date_pattern = re.compile(r"(\d{8}_\d{6})")
+    image_suffixes = {".dng", ".jpg", ".jpeg", ".gif", ".png", ".nef", ".xmp"}
+    video_suffixes = {".mp4", ".mov"}
+    header_size = 256 * 1024
+    sniff_size = 16
+    # Files of one capture in the order they are tried for its timestamp
+    group_order = [".jpg", ".jpeg", ".dng", ".nef", ".xmp", ".png", ".gif"]
+    # Magic numbers used to spot files with the wrong suffix: (offset, bytes, kind)
+    magic_numbers = [
+        (0, b"\xff\xd8\xff", "jpeg"),
+        (0, b"\x89PNG\r\n\x1a\n", "png"),
+        (0, b"GIF8", "gif"),
+        (0, b"II*\x00", "tiff"),
+        (0, b"MM\x00*", "tiff"),
+        (4, b"ftyp", "video"),
+        (0, b"<?xpacket", "xmp"),
+        (0, b"<x:xmpmeta", "xmp"),
+    ]
+    suffix_kinds = {
+        ".jpg": "jpeg",
+        ".jpeg": "jpeg",
+        ".png": "png",
+        ".gif": "gif",
+        ".dng": "tiff",
+        ".nef": "tiff",
+        ".xmp": "xmp",
+        ".mp4": "video",
+        ".mov": "video",
+    }
+    # Extractors tried for each kind, in order: (method name or callable, works on streams)
+    extractor_chains = {
+        "jpeg": [("get_date_from_exif", True), ("get_date_from_xmp", True)],
+        "png": [("get_date_from_exif", True)],
+        "gif": [],
+        "tiff": [("get_date_from_exif", True)],
+        "xmp": [("get_date_from_xmp_sidecar", True)],
+        "video": [("get_date_from_video", False)],
+    }
+    xmp_date_pattern = re.compile(
+        r"(?:exif:DateTimeOriginal|xmp:CreateDate)(?:=\"|>)"
+        r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:\d{2})?)"
+    )
+    manifest_names = {
+        "sha256": "SHA256SUMS",
+        "sha512": "SHA512SUMS",
+        "blake2b": "B2SUMS",
+    }
+    size_units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    copy_block_size = 4 * 1024 * 1024
+    # Files previews are made for with --thumbnails
+    thumbnail_suffixes = {".jpg", ".jpeg", ".png", ".gif"}
+    # Copies of files this big are resumed after an interruption instead of restarted
+    resume_size = 64 * 1024 * 1024
+    # ioctl sharing the data of one file with another on Btrfs, XFS and others
+    ficlone = 0x40049409
+    # Bytes copied between dropping finished pages from the page cache
+    cache_window = 64 * 1024 * 1024
+    hash_buffer_size = 1024 * 1024
+    mmap_threshold = 64 * 1024 * 1024
+    # Files in a sorted library recording its layout and a relayout in progress
+    layout_name = ".layout"
+    journal_name = ".relayout.journal"
+    # Directories changed within this many ns of a scan are read again by the next one
+    snapshot_racy_ns = 2 * 10**9
+    # Logs of files left unsorted, their directories are read again by the next scan
+    snapshot_failures = ("parse", "collisions", "verify", "timeout")
+    # Seconds of work each autotuner step is measured over
+    autotune_window = 2.0
+
+    def __init__(self):
+        self.log = dict()
+        keys = "parse suffix collisions exif google_json_date processed verify"
+        keys += " bitrot missing unexpected partials timeout compact autotune"
+        for key in keys.split():
+            self.log[key] = list()
+
+        self.ignore = set(".DS_Store .thumbnails".split())
+        self.ignore.update(self.manifest_names.values())
+        self.ignore.update((Catalog.name, Catalog.name + "-journal"))
+        self.ignore.update((self.layout_name, self.journal_name))
+        self.rules = RuleSet(sorted(self.ignore))
+
+        self.manifest = False
+        self.verify_copy = False
+        self.manifests = dict()
+        self.hash_algorithm = "sha256"
+        self.stats = Counter()
+        self.shard = None
+        self.shard_by = "path"
+        self.workers = 4
+        self.read_limit = TokenBucket()
+        self.write_limit = TokenBucket()
+        self.ops_limit = TokenBucket()
+        self.limits = dict(read=None, write=None, ops=None)
+        self.limits_changed = threading.Event()
+        self.durability = "none"
+        self.sync_files = 1000
+        self.sync_bytes = 1024**3
+        self.sync_lock = threading.Lock()
+        # Guards the stats, the thumbnail pool and its jobs, used by copy workers
+        self.stats_lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        self.pending = dict(files=set(), directories=set(), sources=[], bytes=0)
+        self.extractor_timeout = 30.0
+        self.watchdogs = threading.local()
+        # Captures whose files are read ahead, 0 to read them when they are sorted
+        self.prefetch = 0
+        # File keeping the directory snapshots of the sources between runs
+        self.snapshot = None
+        self.tracer = None
+        self.profiler = None
+        self.thumbnails = False
+        self.thumbnail_size = 256
+        self.thumbnail_pool = None
+        self.thumbnail_jobs = list()
+        self.hash_buffers = threading.local()
+        self.hash_pool = ThreadPoolExecutor(max_workers=2)
+        # Destination storage, None to write to the local file system directly
+        self.storage = None
+        self.catalog = None
+        self.ledger = None
+        # Size the extract and copy stages while running, within these bounds
+        self.autotune = False
+        self.extract_workers = (1, 16)
+        self.copy_workers = (1, 8)
+        # True to sort files the ledger has seen before
+        self.reimport = False
+        # strftime format of the directories files are sorted into
+        self.layout = "%Y-%m"
+
+    @staticmethod
+    def parse_arguments():
+        """Parse command line arguments."""
+
+        parser = argparse.ArgumentParser(
+            description="""Sort image files based on filename timestamp into year-month folders.
+            Do not use --exif and --google-json together!"""
+        )
+        parser.add_argument(
+            "--move",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Move files instead of copying them (default action is to copy).",
+        )
+        parser.add_argument(
+            "--collisions",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Print out source and destination files with collisions.",
+        )
+        parser.add_argument(
+            "--suffix",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Print out source files with unknown suffixes (extension).",
+        )
+        parser.add_argument(
+            "--parse",
+            action="store_true",
+            required=False,
+            default=False,
             help="Print out source files with filenames that could not be parsed.",
         )
         parser.add_argument(
@@ -85,230 +1722,2852 @@ class SortingPictures:
             help="Do not actually copy or move files.",
         )
         parser.add_argument(
-            "paths",
-            nargs=argparse.REMAINDER,
-            help="source source source ... destination",
+            "--manifest",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Record hashes of copied files in a sha256sum compatible manifest per directory.",
+        )
+        parser.add_argument(
+            "--hash",
+            choices=sorted(SortingPictures.manifest_names),
+            required=False,
+            default="sha256",
+            help="Hash algorithm used to compare and record files (default sha256).",
+        )
+        parser.add_argument(
+            "--verify-copy",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Read copied files back and check them against the hash taken while copying.",
+        )
+        parser.add_argument(
+            "--shard",
+            required=False,
+            default=None,
+            metavar="I/N",
+            help="Only sort the I-th of N shards of the source files, for example 1/4.",
+        )
+        parser.add_argument(
+            "--shard-by",
+            choices=["path", "dir"],
+            required=False,
+            default="path",
+            help="Split shards by the relative path of each file, or by top level directory (default path).",
+        )
+        parser.add_argument(
+            "--report",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="Write the logs and stats of the run to a JSON report.",
+        )
+        parser.add_argument(
+            "--merge-reports",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Treat the paths as JSON reports from --report and combine them instead of sorting.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Print out the run statistics.",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Treat the paths as sorted libraries and check their files against the manifests instead of sorting.",
+        )
+        parser.add_argument(
+            "--compact",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Treat the paths as sorted libraries and replace identical files with reflinks or hard links. "
+            "With --dryrun only report the bytes that would be reclaimed.",
+        )
+        parser.add_argument(
+            "--layout",
+            required=False,
+            default=None,
+            metavar="FORMAT",
+            help="strftime format of the destination directories, for example %%Y/%%Y-%%m "
+            "(default the layout recorded by --relayout, else %%Y-%%m).",
         )
+        parser.add_argument(
+            "--relayout",
+            required=False,
+            default=None,
+            metavar="FORMAT",
+            help="Treat the paths as sorted libraries and move their files into a new layout, with renames only.",
+        )
+        parser.add_argument(
+            "--catalog",
+            action="store_true",
+            required=False,
+            default=False,
+            help=f"Keep an SQLite catalog of the sorted files in {Catalog.name} in the destination.",
+        )
+        parser.add_argument(
+            "--ledger",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="Skip source files recorded in this ledger of past imports, and record the files sorted.",
+        )
+        parser.add_argument(
+            "--reimport",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Sort files the ledger has seen before, recording them again.",
+        )
+        parser.add_argument(
+            "--query",
+            required=False,
+            default=None,
+            metavar="RANGE",
+            help="Treat the paths as sorted libraries and list the files taken in a range from their catalogs, "
+            "for example 2019-03 or 2019-03-01..2019-06-30, or 'months' for the counts of each month.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            required=False,
+            default=4,
+            help="Number of files hashed at the same time by --verify and --compact, and of parts uploaded "
+            "at the same time to an object store (default 4).",
+        )
+        parser.add_argument(
+            "--autotune",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Find timestamps and copy files on pools of workers, sized while running by hill climbing on "
+            "their throughput.",
+        )
+        parser.add_argument(
+            "--extract-workers",
+            required=False,
+            default="1:16",
+            metavar="MIN:MAX",
+            help="Bounds of the workers finding timestamps with --autotune (default 1:16).",
+        )
+        parser.add_argument(
+            "--copy-workers",
+            required=False,
+            default="1:8",
+            metavar="MIN:MAX",
+            help="Bounds of the workers copying files with --autotune (default 1:8).",
+        )
+        parser.add_argument(
+            "--read-limit",
+            "--bwlimit",
+            type=SortingPictures.parse_size,
+            required=False,
+            default=None,
+            metavar="BYTES",
+            help="Limit reads to this many bytes per second, for example 50M.",
+        )
+        parser.add_argument(
+            "--write-limit",
+            type=SortingPictures.parse_size,
+            required=False,
+            default=None,
+            metavar="BYTES",
+            help="Limit writes to this many bytes per second, for example 20M.",
+        )
+        parser.add_argument(
+            "--ops-limit",
+            type=float,
+            required=False,
+            default=None,
+            metavar="OPS",
+            help="Limit file operations (copies, moves and hashes) to this many per second.",
+        )
+        parser.add_argument(
+            "--limits-file",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="JSON file with read, write and ops limits, reloaded when it changes or on SIGUSR1.",
+        )
+        parser.add_argument(
+            "--durability",
+            choices=["none", "batch", "strict"],
+            required=False,
+            default="none",
+            help="none leaves writes to the OS, batch syncs every --sync-files files or --sync-bytes bytes "
+            "and strict syncs every file. Moved sources are only deleted once their copies are synced.",
+        )
+        parser.add_argument(
+            "--sync-files",
+            type=int,
+            required=False,
+            default=1000,
+            metavar="N",
+            help="Files written between syncs with --durability batch (default 1000).",
+        )
+        parser.add_argument(
+            "--sync-bytes",
+            type=SortingPictures.parse_size,
+            required=False,
+            default=1024**3,
+            metavar="BYTES",
+            help="Bytes written between syncs with --durability batch (default 1G).",
+        )
+        parser.add_argument(
+            "--thumbnails",
+            action="store_true",
+            required=False,
+            default=False,
+            help="Write previews of the sorted images into <dest>/.thumbnails/YYYY-MM/.",
+        )
+        parser.add_argument(
+            "--thumbnail-size",
+            type=int,
+            required=False,
+            default=256,
+            metavar="PIXELS",
+            help="Largest width and height of the previews (default 256).",
+        )
+        parser.add_argument(
+            "--snapshot",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="Keep the mtimes of the source directories in FILE and skip the files of directories that haven't changed since the last run.",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            required=False,
+            default=0,
+            metavar="N",
+            help="Read the headers of the next N captures ahead, N at a time, for --exif and --google-json on network mounts.",
+        )
+        parser.add_argument(
+            "--extractor-timeout",
+            type=float,
+            required=False,
+            default=30.0,
+            metavar="SECONDS",
+            help="Give up reading the metadata of a file after this long, 0 to wait forever (default 30).",
+        )
+        parser.add_argument(
+            "--exclude",
+            action="append",
+            dest="rules",
+            required=False,
+            default=None,
+            metavar="PATTERN",
+            help="Skip files and directories matching a gitignore style pattern, for example @eaDir/. Can be repeated.",
+        )
+        parser.add_argument(
+            "--include",
+            action="append",
+            dest="rules",
+            type=lambda x: "!" + x,
+            required=False,
+            metavar="PATTERN",
+            help="Sort files matching a pattern even if an earlier --exclude matched them. Can be repeated.",
+        )
+        parser.add_argument(
+            "--rules-file",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="File of gitignore style rules, applied before --exclude and --include.",
+        )
+        parser.add_argument(
+            "--profile",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="Write cProfile data of the run, merged across threads and processes, to a pstats file.",
+        )
+        parser.add_argument(
+            "--trace",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="Write a Chrome trace of the scan, extractors, hashes and copies, for Perfetto or chrome://tracing.",
+        )
+        parser.add_argument(
+            "--endpoint",
+            required=False,
+            default=None,
+            metavar="URL",
+            help="URL of the S3 compatible object store for an s3://bucket/prefix destination (default AWS_ENDPOINT_URL or AWS S3).",
+        )
+        parser.add_argument(
+            "--part-size",
+            type=SortingPictures.parse_size,
+            required=False,
+            default=8 * 1024**2,
+            metavar="BYTES",
+            help="Files bigger than this are uploaded to the object store in parts of this size (default 8M).",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            required=False,
+            default=None,
+            metavar="FILE",
+            help="File recording the directories --verify has finished, so an interrupted run can carry on.",
+        )
+        parser.add_argument(
+            "paths",
+            nargs=argparse.REMAINDER,
+            help="source source source ... destination",
+        )
+
+        return parser
+
+    @classmethod
+    def parse_size(cls, size):
+        """Convert a size such as 500K or 2G into bytes.
+
+        :param size: Size, with an optional K, M, G or T suffix.
+        :return: int
+        """
+        unit = cls.size_units.get(size[-1:].upper())
+        if unit is None:
+            return int(size)
+        return int(float(size[:-1]) * unit)
+
+    def set_limits(self, read=None, write=None, ops=None):
+        """Set the read, write and file operation limits.
+
+        The limits are shared by every thread of the run. When sharded each
+        run takes an equal share, so all N shards together stay within them.
+
+        :param read: Read bytes per second, None for no limit.
+        :param write: Write bytes per second, None for no limit.
+        :param ops: File operations per second, None for no limit.
+        :return: None
+        """
+
+        self.limits = dict(read=read, write=write, ops=ops)
+        count = self.shard[1] if self.shard else 1
+        for bucket, rate in (
+            (self.read_limit, read),
+            (self.write_limit, write),
+            (self.ops_limit, ops),
+        ):
+            bucket.set_rate(rate / count if rate else None)
+
+    def load_limits(self, limits_file):
+        """Load the limits from a JSON file such as {"read": "50M", "ops": 100}.
+
+        Missing keys keep their current limit, null or 0 removes it.
+
+        :param limits_file: Path of the limits file.
+        :return: True if the limits were loaded, False otherwise.
+        """
+
+        limits = dict(self.limits)
+        try:
+            with open(limits_file) as in_file:
+                changes = json.load(in_file)
+            for key in "read", "write":
+                if key in changes:
+                    limits[key] = changes[key] and self.parse_size(str(changes[key]))
+            if "ops" in changes:
+                limits["ops"] = changes["ops"] and float(changes["ops"])
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            print("Could not load limits from", limits_file, e)
+            return False
+
+        self.set_limits(**limits)
+        return True
+
+    def watch_limits(self, limits_file, interval=1.0):
+        """Reload the limits when the limits file changes or SIGUSR1 is received.
+
+        :param limits_file: Path of the limits file.
+        :param interval: Seconds between checks of the file.
+        :return: The watching thread.
+        """
+
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(
+                signal.SIGUSR1, lambda signum, frame: self.limits_changed.set()
+            )
+
+        def watch():
+            loaded = None
+            while True:
+                try:
+                    mtime = os.stat(limits_file).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if self.limits_changed.is_set() or mtime not in (loaded, None):
+                    self.limits_changed.clear()
+                    self.load_limits(limits_file)
+                    loaded = mtime
+                self.limits_changed.wait(interval)
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        return thread
+
+    def span(self, name, category, path=None, **args):
+        """Trace the body of a `with` block when a trace was asked for.
+
+        :param name: Name of the span.
+        :param category: Category of the span.
+        :param path: File the span works on.
+        :param args: Other values to show with the span.
+        :return: Context manager giving the args.
+        """
+
+        if self.tracer is None:
+            return contextlib.nullcontext(args)
+        return self.tracer.span(name, category, path, **args)
+
+    def profiled(self, function):
+        """Wrap a function run on a worker thread so it is profiled when asked for.
+
+        :param function: Function to wrap.
+        :return: The function, wrapped if profiling.
+        """
+
+        if self.profiler is None:
+            return function
+        return self.profiler.wrap(function)
+
+    def get_date_from_video(self, filename):
+        """Extract the date from a video file using ffprobe.
+
+        ffprobe is killed if it runs for more than `extractor_timeout` seconds.
+        """
+        result = subprocess.run(
+            ["ffprobe", filename],
+            capture_output=True,
+            timeout=self.extractor_timeout or None,
+        )
+        stdout = result.stdout.decode(encoding="utf-8")
+        stderr = result.stderr.decode(encoding="utf-8")
+        if result.returncode:
+            return None
+
+        for timestamp in [
+            x.strip() for x in stderr.split("\n") if "creation_time" in x
+        ]:
+            entry = timestamp.split(":", 1)
+            if len(entry) != 2:
+                continue
+            t = entry[1].strip()
+            if "Z" in t:
+                t = t.replace("Z", "+00:00")
+            try:
+                r = datetime.fromisoformat(t)
+            except ValueError:
+                print(f"File {filename} with timestamp {t}")
+                continue
+            return r
+        return None
+
+    @classmethod
+    def google_json_names(cls, filename):
+        """Get the names the Google Photos JSON file of an image can have.
+
+        :param filename: Filename of the image.
+        :return: list of paths, in the order they are tried.
+        """
+
+        if filename.name != "sp-n-mobo-c (1).jpg":
+            return list()
+
+        matches = re.search("\(\d+\)", filename.name)
+        if not matches:
+            json_filename = filename.parent / Path(filename.name + ".json")
+        elif matches.group(0):
+            filename_nameonly = filename.stem.split("(", 1)
+            if len(filename_nameonly) < 2:
+                return list()
+            filename_nameonly = filename_nameonly[0]
+            json_filename = filename.parent / Path(
+                filename_nameonly + filename.suffix + matches.group(0) + ".json"
+            )
+        else:
+            return list()
+
+        # Need to check for the same name, no changes, just json appeneded even though (\d+) in it
+        # Try alternate form
+        return [json_filename, filename.parent / Path(filename.name + ".json")]
+
+    @classmethod
+    def get_google_json_date(cls, filename, archive=None, files=None):
+        """Extract the image creation date from Google Photos JSON file.
+
+        :param filename: Filename of the JSON file to load.
+        :param archive: Archive to read the JSON file from, None to read from disk.
+        :param files: dict of paths to whether they are files, already looked up.
+        :return: datetime.datetime
+        """
+
+        def is_file(path):
+            if files is not None and path in files:
+                return files[path]
+            if archive is None:
+                return path.is_file()
+            return archive.is_file(path)
+
+        for json_filename in cls.google_json_names(filename):
+            if is_file(json_filename):
+                break
+        else:
+            return None
+
+        try:
+            if archive is None:
+                with open(json_filename) as in_file:
+                    data = json.load(in_file)
+            else:
+                data = json.loads(archive.read(str(json_filename)))
+        except UnicodeDecodeError:
+            return None
+
+        return datetime.fromtimestamp(int(data["photoTakenTime"]["timestamp"]))
+
+    @classmethod
+    def get_date_from_exif(cls, filename):
+        """Get the timestamp from the file's exif data.
+
+        :param filename: Filename of the image file.
+        :return: datetime.datetime
+        """
+        try:
+            exif = Image.open(filename).getexif()
+        except UnidentifiedImageError:
+            return None
+        timestamp = exif.get(306)
+        if timestamp is None:
+            return None
+        try:
+            return datetime.strptime(timestamp, "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            raise
+
+    @classmethod
+    def get_date_from_xmp(cls, filename):
+        """Get the timestamp from the file's exif xmp data.
+
+        :param filename: Filename of the image file.
+        :return: datetime.datetime
+        """
+        try:
+            with Image.open(filename) as img:
+                if not hasattr(img, "applist"):
+                    return None
+                for segment, content in img.applist:
+                    if b"\x00" not in content:
+                        continue
+                    marker, body = content.split(b"\x00", 1)
+                    if segment == "APP1" and marker == b"http://ns.adobe.com/xap/1.0/":
+                        body = body.decode("utf-8")
+                        pattern = re.compile(
+                            'exif:DateTimeOriginal="(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\+\d{2}:\d{2})'
+                        )
+                        timestamp = pattern.search(body)
+                        if timestamp is None:
+                            continue
+                        timestamp = timestamp.group(1)
+                        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+        except UnidentifiedImageError:
+            pass
+        return None
+
+    @classmethod
+    def get_date_from_xmp_sidecar(cls, filename):
+        """Get the timestamp from an XMP sidecar file.
+
+        :param filename: Filename or binary file object of the sidecar.
+        :return: datetime.datetime
+        """
+        if hasattr(filename, "read"):
+            data = filename.read()
+        else:
+            with open(filename, "rb") as in_file:
+                data = in_file.read()
+
+        timestamp = cls.xmp_date_pattern.search(data.decode("utf-8", "replace"))
+        if timestamp is None:
+            return None
+        try:
+            return datetime.fromisoformat(timestamp.group(1).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+
+    @classmethod
+    def register_extractor(cls, kind, extractor, streams=True, first=False):
+        """Register a timestamp extractor for a kind of file.
+
+        :param kind: Kind of file, see `suffix_kinds` and `magic_numbers`.
+        :param extractor: Method name or callable taking a path, or a binary file
+            object if `streams` is True, and returning a datetime.datetime or None.
+        :param streams: False if the extractor can only read files on disk.
+        :param first: True to try it before the extractors already registered.
+        :return: None
+        """
+        chain = cls.extractor_chains.setdefault(kind, list())
+        if first:
+            chain.insert(0, (extractor, streams))
+        else:
+            chain.append((extractor, streams))
+
+    @classmethod
+    def sniff(cls, header):
+        """Work out the kind of a file from its first bytes.
+
+        :param header: Start of the file.
+        :return: Kind of file, None if it wasn't recognised.
+        """
+        for offset, magic, kind in cls.magic_numbers:
+            if header[offset : offset + len(magic)] == magic:
+                return kind
+        return None
+
+    def get_date_from_metadata(self, src, header=None, streams_only=True):
+        """Get the timestamp from a file's metadata.
+
+        Only the extractors registered for the kind of file are tried. The kind
+        comes from the file's magic number, falling back to its suffix.
+
+        :param src: Path of the file.
+        :param header: Start of the file if it isn't on disk, for example an archive
+            member, or if it was read ahead.
+        :param streams_only: False to still run the extractors that need a path when
+            a header is given, True if the file isn't on disk.
+        :return: datetime.datetime
+        """
+
+        if header is None:
+            try:
+                with open(src, "rb") as in_file:
+                    kind = self.sniff(in_file.read(self.sniff_size))
+            except OSError:
+                kind = None
+        else:
+            kind = self.sniff(header)
+        if kind is None:
+            kind = self.suffix_kinds.get(src.suffix.lower())
+
+        watchdog = getattr(self.watchdogs, "watchdog", None)
+        if watchdog is None:
+            watchdog = self.watchdogs.watchdog = Watchdog(self.extractor_timeout)
+        watchdog.timeout = self.extractor_timeout
+
+        for extractor, streams in self.extractor_chains.get(kind, list()):
+            if header is not None and not streams and streams_only:
+                continue
+            if isinstance(extractor, str):
+                extractor = getattr(self, extractor)
+            name = getattr(extractor, "__name__", str(extractor))
+            try:
+                if header is None or not streams:
+                    with self.span(name, "extract", src):
+                        d = watchdog.call(self.profiled(extractor), src)
+                else:
+                    d = self.extract_header(extractor, src, header, streams_only)
+            except (TimeoutError, subprocess.TimeoutExpired):
+                # Leave the file to the other ways of finding a timestamp
+                self.log["timeout"].append(src)
+                return None
+            if d is not None:
+                return d
+        return None
+
+    def extract_header(self, extractor, src, header, streams_only=True):
+        """Run an extractor on the start of a file.
+
+        If the metadata lies beyond the end of the header, as in a PNG whose
+        `eXIf` chunk comes after its image data, the extractor fails on the cut
+        short data. The file is then read from its path if it is on disk, otherwise
+        no timestamp is found.
+
+        :param extractor: Extractor taking a binary file object.
+        :param src: Path of the file.
+        :param header: Start of the file.
+        :param streams_only: True if the file isn't on disk.
+        :return: datetime.datetime, None if no timestamp was found.
+        """
+
+        watchdog = self.watchdogs.watchdog
+        name = getattr(extractor, "__name__", str(extractor))
+        try:
+            with self.span(name, "extract", suffix=src.suffix.lower()):
+                return watchdog.call(self.profiled(extractor), io.BytesIO(header))
+        except TimeoutError:
+            raise
+        except (OSError, SyntaxError, EOFError, struct.error):
+            if streams_only or len(header) < self.header_size:
+                return None
+        with self.span(name, "extract", src):
+            return watchdog.call(self.profiled(extractor), src)
+
+    @classmethod
+    def get_date_from_filename(cls, filename):
+        """Derive the images timestamp from the filename.
+
+        :param filename: Filename of the image file.
+        :return: datetime.datetime
+        """
+        f = cls.date_replace.sub("_", str(filename))
+        match = cls.date_pattern.search(f)
+        if match is None:
+            return None
+
+        try:
+            return datetime.strptime(match.group(0), "%Y%m%d_%H%M%S")
+        except ValueError:
+            return None
+
+    def search_directory(self, sp):
+        """Return the contents of a directory.
+
+        :param sp: Path to search.
+        :return: list of directory contents.
+        """
+
+        return [x for x in Path(sp).rglob("*") if not set(x.parts) & self.ignore]
+
+    def scan_directory(self, sp, previous=None, current=None):
+        """Scan a directory tree into a `FileTable`.
+
+        Ignored names are pruned. Directories, and symlinks to them, are left out.
+        The files of a directory are next to each other in the table, sorted by name.
+
+        With a snapshot of an earlier scan, directories whose mtime hasn't changed
+        are only stat'ed. Their files are left out, only their subdirectories are
+        scanned.
+
+        :param sp: Path to scan.
+        :param previous: Snapshot of an earlier scan, from `load_snapshot`.
+        :param current: dict to fill with the snapshot of this scan, None for none.
+        :return: FileTable
+        """
+
+        table = FileTable()
+        stack = [(str(sp), "")]
+        # Directories changed this close to the scan could change again within
+        # the same mtime, they are always read next time
+        racy = time.time_ns() - self.snapshot_racy_ns
+        while stack:
+            directory, relative = stack.pop()
+            if current is not None:
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                entry = (previous or dict()).get(relative)
+                if entry is not None and entry[0] == mtime:
+                    current[relative] = entry
+                    self.count("snapshot_directories")
+                    self.count("snapshot_files", entry[1])
+                    stack.extend(
+                        (os.path.join(directory, x), relative + x + "/")
+                        for x in reversed(entry[2])
+                    )
+                    continue
+            try:
+                entries = sorted(os.scandir(directory), key=lambda x: x.name)
+            except OSError:
+                continue
+
+            parent = None
+            directories = list()
+            count = len(table)
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if self.is_excluded(relative + entry.name, is_dir):
+                        # Excluded directories are pruned, nothing below them is read
+                        continue
+                    if is_dir:
+                        directories.append((entry.path, relative + entry.name + "/"))
+                        continue
+                    elif entry.is_dir():
+                        continue
+                    info = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if parent is None:
+                    parent = table.add_directory(directory)
+                table.add(parent, entry.name, info.st_size, info.st_mtime_ns)
+            stack.extend(reversed(directories))
+            if current is not None:
+                current[relative] = (
+                    mtime if mtime < racy else None,
+                    len(table) - count,
+                    [x[1][len(relative) : -1] for x in directories],
+                )
+
+        return table
+
+    def snapshot_settings(self, dest_path, exif=False, google_json_date=False):
+        """Describe the settings that decide which files a scan keeps and where
+        they are sorted to.
+
+        A snapshot taken with other settings can't be used, the files of unchanged
+        directories may not have been sorted with these.
+
+        :param dest_path: Destination path.
+        :param exif: True if exif data is used for timestamps.
+        :param google_json_date: True if Google JSON files are used for timestamps.
+        :return: str
+        """
+
+        storage = self.storage
+        if storage is not None:
+            dest = f"s3://{storage.host}/{storage.bucket}/{storage.prefix}"
+        else:
+            dest = os.path.abspath(dest_path)
+        ledger = None if self.ledger is None else self.ledger.path
+        return json.dumps(
+            [
+                [x[0] for x in self.rules.rules],
+                self.shard,
+                self.shard_by,
+                dest,
+                exif,
+                google_json_date,
+                self.layout,
+                ledger,
+            ]
+        )
+
+    def load_snapshot(self, src_path, settings):
+        """Load the snapshot of a source from the `snapshot` file.
+
+        :param src_path: Source path.
+        :param settings: Current settings, from `snapshot_settings`.
+        :return: dict of relative directory to (mtime, files, subdirectories), empty if
+            there's no usable snapshot.
+        """
+
+        try:
+            with open(self.snapshot) as in_file:
+                sources = json.load(in_file)
+        except (FileNotFoundError, ValueError):
+            return dict()
+        source = sources.get(os.path.abspath(src_path))
+        if source is None or source["settings"] != settings:
+            return dict()
+        return {key: tuple(value) for key, value in source["directories"].items()}
+
+    def save_snapshot(self, src_path, directories, settings):
+        """Save the snapshot of a source in the `snapshot` file, next to the others.
+
+        :param src_path: Source path.
+        :param directories: Snapshot filled by `scan_directory`.
+        :param settings: Settings the snapshot was taken with, from `snapshot_settings`.
+        :return: None
+        """
+
+        try:
+            with open(self.snapshot) as in_file:
+                sources = json.load(in_file)
+        except (FileNotFoundError, ValueError):
+            sources = dict()
+        sources[os.path.abspath(src_path)] = {
+            "settings": settings,
+            "directories": directories,
+        }
+        temp = Path(str(self.snapshot) + ".tmp")
+        with open(temp, "w") as out_file:
+            json.dump(sources, out_file)
+        os.replace(temp, self.snapshot)
+
+    def is_excluded(self, path, directory=False):
+        """Check a path against the include and exclude rules, counting rule hits.
+
+        :param path: Path relative to the source, with / separators.
+        :param directory: True if the path is a directory.
+        :return: True if the path is excluded, False otherwise.
+        """
+
+        match = self.rules.match(path, directory)
+        if match is None:
+            return False
+        rule, include = match
+        self.count("rule " + rule)
+        return not include
+
+    @staticmethod
+    def is_file(file_path):
+        """Check if the path is a file or something else.
+
+        :param file_path: Path to check.
+        :return: True if it is a file, False otherwise.
+        """
+
+        p = Path(file_path)
+
+        if p.is_symlink():
+            return False
+        elif p.is_file():
+            return True
+        elif p.is_dir():
+            return False
+        else:
+            return False
+
+    @property
+    def manifest_name(self):
+        """Name of the manifest file for the selected hash algorithm."""
+        return self.manifest_names[self.hash_algorithm]
+
+    def hash_file(self, file_path):
+        """Hash the contents of a file.
+
+        Small files are read into a reusable per thread buffer, files of
+        `mmap_threshold` bytes or more are memory mapped and hashed in one call.
+
+        :param file_path: File to hash.
+        :return: Hex digest of the file contents.
+        """
+
+        self.ops_limit.consume(1)
+        with self.span("hash", "hash", file_path), open(file_path, "rb") as file_in:
+            size = os.fstat(file_in.fileno()).st_size
+            if size >= self.mmap_threshold:
+                digest = hashlib.new(self.hash_algorithm)
+                with mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if not self.read_limit.rate:
+                        digest.update(data)
+                    else:
+                        view = memoryview(data)
+                        for offset in range(0, size, self.hash_buffer_size):
+                            block = view[offset : offset + self.hash_buffer_size]
+                            self.read_limit.consume(len(block))
+                            digest.update(block)
+                        del block, view
+                return digest.hexdigest()
+
+            return self.hash_stream(file_in)
+
+    def hash_stream(self, file_in):
+        """Hash everything left in a binary file object.
+
+        :param file_in: File object to read from.
+        :return: Hex digest of the data.
+        """
+
+        digest = hashlib.new(self.hash_algorithm)
+
+        buffer = self.get_buffer("hash", self.hash_buffer_size)
+        while True:
+            count = file_in.readinto(buffer)
+            if not count:
+                break
+            self.read_limit.consume(count)
+            digest.update(buffer[:count])
+
+        return digest.hexdigest()
+
+    def get_buffer(self, name, size):
+        """Get a reusable, page aligned buffer of the current thread.
+
+        :param name: Name of the buffer, one per use.
+        :param size: Size of the buffer in bytes.
+        :return: memoryview of the buffer.
+        """
+
+        buffer = getattr(self.hash_buffers, name, None)
+        if buffer is None or len(buffer) != size:
+            buffer = memoryview(mmap.mmap(-1, size))
+            setattr(self.hash_buffers, name, buffer)
+        return buffer
+
+    @staticmethod
+    def advise(fd, offset, length, advice):
+        """Give the kernel advice about how a file will be used.
+
+        Does nothing where `posix_fadvise` is not available.
+
+        :param fd: File descriptor, None to do nothing.
+        :param offset: Start of the range.
+        :param length: Length of the range, 0 for the rest of the file.
+        :param advice: Name of the advice, for example "POSIX_FADV_DONTNEED".
+        :return: None
+        """
+
+        if fd is None or not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+    @staticmethod
+    def file_descriptor(file_obj):
+        """File descriptor of a file object, None for streams without one.
+
+        :param file_obj: File object, such as an open file or an archive member.
+        :return: int or None
+        """
+
+        try:
+            return file_obj.fileno()
+        except (AttributeError, OSError):
+            return None
+
+    def load_manifest(self, directory):
+        """Load the hash manifest of a destination directory.
+
+        :param directory: Directory holding the manifest.
+        :return: dict of file name to hex digest.
+        """
+
+        directory = Path(directory)
+        if directory not in self.manifests:
+            hashes = dict()
+            manifest = directory / self.manifest_name
+            if manifest.is_file():
+                with open(manifest) as in_file:
+                    for line in in_file:
+                        entry = line.rstrip("\n").split(" ", 1)
+                        if len(entry) != 2:
+                            continue
+                        hashes[entry[1][1:]] = entry[0]
+            # Another thread may have loaded it meanwhile, keep the first copy
+            self.manifests.setdefault(directory, hashes)
+
+        return self.manifests[directory]
+
+    def record_hash(self, file_path, digest):
+        """Append a file's hash to the manifest in its directory.
+
+        :param file_path: Destination file the hash belongs to.
+        :param digest: Hex digest of the file contents.
+        :return: None
+        """
+
+        file_path = Path(file_path)
+        hashes = self.load_manifest(file_path.parent)
+        if hashes.get(file_path.name) == digest:
+            return
+
+        with open(file_path.parent / self.manifest_name, "a") as out_file:
+            out_file.write(f"{digest}  {file_path.name}\n")
+        hashes[file_path.name] = digest
+        self.sync_file(file_path.parent / self.manifest_name)
+
+    def dest_hash(self, dest_file):
+        """Hash a destination file, reusing the manifest entry if there is one.
+
+        :param dest_file: Destination file.
+        :return: Hex digest of the file contents.
+        """
+
+        dest_file = Path(dest_file)
+        if self.manifest:
+            digest = self.load_manifest(dest_file.parent).get(dest_file.name)
+            if digest is not None:
+                return digest
+        if self.catalog is not None:
+            row = self.catalog.lookup(dest_file)
+            info = dest_file.stat()
+            if (
+                row is not None
+                and row[3] is not None
+                and row[:3] == (info.st_size, info.st_mtime_ns, self.hash_algorithm)
+            ):
+                return row[3]
+
+        digest = self.hash_file(dest_file)
+        if self.manifest:
+            self.record_hash(dest_file, digest)
+        self.record_catalog(dest_file, digest)
+        return digest
+
+    def record_catalog(self, dest_file, digest=None):
+        """Queue a destination file for the catalog, if there is one.
+
+        The timestamp is taken from the destination name.
+
+        :param dest_file: Destination file.
+        :param digest: Hex digest of the file, None if not known.
+        :return: None
+        """
+
+        if self.catalog is None:
+            return
+        dest_file = Path(dest_file)
+        info = dest_file.stat()
+        self.catalog.add(
+            dest_file,
+            self.get_date_from_filename(dest_file.name),
+            info.st_size,
+            info.st_mtime_ns,
+            self.hash_algorithm,
+            digest,
+        )
+
+    def open_catalog(self, dest_path):
+        """Open the catalog of a library, adding the files already there if it is new.
+
+        :param dest_path: Destination path.
+        :return: Catalog
+        """
+
+        self.catalog = Catalog(dest_path)
+        if self.catalog.created:
+            self.build_catalog(dest_path)
+        return self.catalog
+
+    def check_ledger(self, group):
+        """Fingerprint the files of a capture and check them against the ledger.
+
+        :param group: Files of one capture.
+        :return: dict of each file to its (fingerprint, size), {} without a ledger,
+            None if every file was imported before and is skipped.
+        """
+
+        if self.ledger is None:
+            return dict()
+        fingerprints = {src: self.ledger.fingerprint(src) for src in group}
+        if self.reimport or not all(x[0] in self.ledger for x in fingerprints.values()):
+            return fingerprints
+        self.count("ledger_skipped", len(group))
+        return None
+
+    @staticmethod
+    def parse_range(spec):
+        """Parse a time range such as 2019, 2019-03 or 2019-03-01..2019-06-30.
+
+        Each end can be a year, a month or a day and the end is included.
+
+        :param spec: Range string.
+        :return: tuple of the start and the end, not included.
+        """
+
+        first, _, last = spec.partition("..")
+        ends = list()
+        for value, end in ((first, False), (last or first, True)):
+            parts = [int(x) for x in value.split("-")]
+            if not 1 <= len(parts) <= 3:
+                raise ValueError(value)
+            start = datetime(*(parts + [1] * (3 - len(parts))))
+            if end and len(parts) == 1:
+                start = start.replace(year=start.year + 1)
+            elif end and len(parts) == 2:
+                start = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+            elif end:
+                start += timedelta(days=1)
+            ends.append(start)
+        return tuple(ends)
+
+    def query_catalog(self, dest_path, spec):
+        """Print the files taken in a range, or the counts of each month, from a catalog.
+
+        :param dest_path: Destination path.
+        :param spec: Range string for `parse_range`, or "months".
+        :return: None
+        """
+
+        catalog = self.open_catalog(dest_path)
+        try:
+            if spec == "months":
+                for month, images, videos, size in catalog.months():
+                    print(
+                        "month",
+                        month,
+                        "images",
+                        images,
+                        "videos",
+                        videos,
+                        "bytes",
+                        size,
+                    )
+                return
+            files = catalog.between(*self.parse_range(spec))
+            for path, taken, size in files:
+                print("file", taken, size, Path(dest_path) / path)
+            print("total", len(files), "bytes", sum(x[2] for x in files))
+        finally:
+            catalog.close()
+            self.catalog = None
+
+    def build_catalog(self, dest_path):
+        """Add the files already in a library to its catalog.
+
+        Hashes are taken from the manifests where there are any, nothing is read.
+
+        :param dest_path: Destination path.
+        :return: None
+        """
+
+        table = self.scan_directory(dest_path)
+        for row in range(len(table)):
+            name = table.name(row)
+            if name.startswith(".") and name.endswith(".part"):
+                if self.stale_partial(table.path(row)):
+                    self.log["partials"].append(table.path(row))
+                continue
+            path = table.path(row)
+            self.catalog.add(
+                path,
+                self.get_date_from_filename(name),
+                table.sizes[row],
+                table.mtimes[row],
+                self.hash_algorithm,
+                self.load_manifest(path.parent).get(name),
+            )
+        self.catalog.commit()
+
+    def diff_files(self, src_file, dest_file):
+        """Hash two files and see if they are the same or not.
+
+        :param src_file: Source file.
+        :param dest_file: Destination file.
+        :return: True if hash matches, False if different.
+        """
+
+        if Path(src_file).stat().st_size != Path(dest_file).stat().st_size:
+            return False
+
+        src_hash = self.hash_pool.submit(self.profiled(self.hash_file), src_file)
+        dest_hash = self.dest_hash(dest_file)
+
+        return src_hash.result() == dest_hash
+
+    def copy_file(self, src_file, dest_file, resumable=False):
+        """Copy a file, hashing the data as it is written.
+
+        If dest_file already holds the start of the copy, left by an interrupted run,
+        the copy carries on from there.
+
+        :param src_file: Source path.
+        :param dest_file: Destination path.
+        :param resumable: True if dest_file is kept when the copy is interrupted.
+        :return: Hex digest of the copied data, None if verification failed.
+        """
+
+        with open(src_file, "rb") as file_in:
+            size = os.fstat(file_in.fileno()).st_size
+            offset, digest = self.resume_offset(file_in, dest_file)
+            digest = self.write_file(
+                file_in, dest_file, size, offset, digest, resumable
+            )
+        shutil.copystat(src_file, dest_file)
+
+        return self.check_copy(dest_file, digest)
+
+    def resume_offset(self, file_in, partial):
+        """Work out where an interrupted copy can carry on from.
+
+        The partial copy is cut back to a whole number of blocks and compared with
+        the start of the source while it is hashed, so the digest covers the whole
+        file. If all of it matches the source is positioned after it. Both prefixes
+        are read, which is still half the reads of starting over.
+
+        :param file_in: Source file object, positioned at the start.
+        :param partial: Destination path, possibly holding part of the copy.
+        :return: tuple of the offset to carry on from and the digest so far, or 0
+            and None to start over.
+        """
+
+        try:
+            offset = os.stat(partial).st_size
+        except FileNotFoundError:
+            return 0, None
+        offset -= offset % self.copy_block_size
+        if not offset:
+            return 0, None
+
+        with open(partial, "rb") as partial_in:
+            digest = hashlib.new(self.hash_algorithm)
+            buffer = self.get_buffer("hash", self.hash_buffer_size)
+            remaining = offset
+            while remaining:
+                count = partial_in.readinto(buffer[: min(remaining, len(buffer))])
+                if not count or file_in.read(count) != buffer[:count]:
+                    # Written by an older copy of the source, or damaged
+                    file_in.seek(0)
+                    return 0, None
+                digest.update(buffer[:count])
+                remaining -= count
+
+        file_in.seek(offset)
+        self.count("resumed")
+        self.count("resumed_bytes", offset)
+        return offset, digest
+
+    def copy_member(self, archive, name, dest_file):
+        """Copy an archive member to the destination, hashing the data as it is written.
+
+        :param archive: Archive holding the member.
+        :param name: Member name.
+        :param dest_file: Destination path.
+        :return: Hex digest of the copied data, None if verification failed.
+        """
+
+        with archive.open(name) as file_in:
+            digest = self.write_file(file_in, dest_file, archive.size(name))
+        mtime = archive.mtime(name)
+        os.utime(dest_file, (mtime, mtime))
+
+        return self.check_copy(dest_file, digest)
+
+    def write_file(
+        self, file_in, dest_file, size=None, offset=0, digest=None, resumable=False
+    ):
+        """Write a stream to a file while hashing it.
+
+        The destination is preallocated when the size is known, unless the copy can
+        be resumed: the size of its partial copy has to show how far it got. Both files are read and written sequentially and every
+        `cache_window` bytes the pages already copied are dropped from the page
+        cache, so bulk copies do not push out data other programs need.
+
+        :param file_in: Binary file object to read from.
+        :param dest_file: Destination path.
+        :param size: Expected number of bytes, None if not known.
+        :param offset: Bytes already in dest_file, the stream is positioned after them.
+        :param digest: Hash object holding the first offset bytes.
+        :param resumable: True if dest_file is kept when the copy is interrupted.
+        :return: Hex digest of the written data.
+        """
+
+        if digest is None:
+            digest = hashlib.new(self.hash_algorithm)
+        buffer = self.get_buffer("copy", self.copy_block_size)
+        src_fd = self.file_descriptor(file_in)
+        self.advise(src_fd, offset, 0, "POSIX_FADV_SEQUENTIAL")
+
+        with open(dest_file, "r+b" if offset else "wb", buffering=0) as file_out:
+            dest_fd = file_out.fileno()
+            if offset:
+                file_out.truncate(offset)
+                file_out.seek(offset)
+            elif size and not resumable and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(dest_fd, 0, size)
+                except OSError:
+                    pass  # Not supported by the file system
+
+            written = dropped = offset
+            while True:
+                count = file_in.readinto(buffer)
+                if not count:
+                    break
+                self.read_limit.consume(count)
+                digest.update(buffer[:count])
+                self.write_limit.consume(count)
+                done = 0
+                while done < count:
+                    done += file_out.write(buffer[done:count])
+                written += count
+                # Drop the window before last. Dirty destination pages are only
+                # queued for writeback by the first advice, so the window before
+                # that is advised again once its writes are done.
+                while written - dropped >= 2 * self.cache_window:
+                    for fd in src_fd, dest_fd:
+                        self.advise(
+                            fd, dropped, self.cache_window, "POSIX_FADV_DONTNEED"
+                        )
+                    if dropped:
+                        self.advise(
+                            dest_fd,
+                            dropped - self.cache_window,
+                            self.cache_window,
+                            "POSIX_FADV_DONTNEED",
+                        )
+                    dropped += self.cache_window
+
+            if size and written < size:
+                file_out.truncate(written)
+            for fd in src_fd, dest_fd:
+                self.advise(fd, dropped, 0, "POSIX_FADV_DONTNEED")
+
+        return digest.hexdigest()
+
+    def check_copy(self, dest_file, digest):
+        """Verify and record the hash of a file that was just written.
+
+        :param dest_file: Destination path.
+        :param digest: Hex digest taken while writing the file.
+        :return: The digest, None if verification failed.
+        """
+
+        if self.verify_copy and self.hash_file(dest_file) != digest:
+            Path(dest_file).unlink()
+            return None
+
+        return digest
+
+    @staticmethod
+    def temp_file(dest):
+        """Create an empty temporary file next to a destination file.
+
+        The file gets the mode of any new file, not the private one of mkstemp, as
+        it is renamed into place.
+
+        :param dest: Destination path the data is meant for.
+        :return: Path of the temporary file.
+        """
+
+        fd, temp = tempfile.mkstemp(
+            prefix=f".{dest.name}.", suffix=".part", dir=dest.parent
+        )
+        try:
+            os.fchmod(fd, FILE_MODE)
+        finally:
+            os.close(fd)
+        return Path(temp)
+
+    def claim_file(self, src, dest, same_file, placeholder=False, index=0, keep=False):
+        """Rename a file to the first destination name that is free.
+
+        A name is claimed by hard linking to it, which fails if it is already taken,
+        so concurrent writers never overwrite each other. If a taken name holds the
+        same data the source is simply removed.
+
+        :param src: File to rename, on the same file system as dest.
+        :param dest: Preferred destination path.
+        :param same_file: Callable returning True if a destination path holds the source data.
+        :param placeholder: True to claim names with an O_EXCL placeholder and a rename
+            if hard links aren't supported, src must then be in the destination directory.
+        :param index: Collision index of the first name to try.
+        :param keep: True to only link, src is left for the caller to remove.
+        :return: Destination path holding the data, None if src couldn't be linked.
+        """
+
+        while True:
+            candidate = self.destination_name(dest, index)
+            try:
+                try:
+                    os.link(src, candidate)
+                    if not keep:
+                        os.unlink(src)
+                except FileExistsError:
+                    raise
+                except OSError:
+                    if not placeholder:
+                        return None
+                    os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    os.replace(src, candidate)
+                return candidate
+            except FileExistsError:
+                if self.is_file(candidate) and same_file(candidate):
+                    if not keep:
+                        os.unlink(src)
+                    return candidate
+
+            index += 1
+
+    def partial_file(self, dest, src):
+        """Open the partial copy of a source file, which keeps its name between runs.
+
+        The file is locked so two runs can't write to it at the same time.
+
+        :param dest: Preferred destination path.
+        :param src: Source file.
+        :return: tuple of the path and an open file descriptor holding the lock,
+            None if another run is writing it.
+        """
+
+        stat = os.stat(src)
+        key = f"{os.path.abspath(src)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        key = hashlib.sha256(key.encode("utf-8", "surrogateescape")).hexdigest()
+        path = dest.parent / f".{dest.name}.{key[:16]}.part"
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, FILE_MODE)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return None
+        return path, fd
+
+    def stale_partial(self, path):
+        """Check whether a file is a partial copy that no run is writing.
+
+        Partial copies are kept for the next run over the same source to resume.
+        One whose source was changed or removed is never resumed, and as its name
+        only holds a hash of the source it can't be told apart from one that will
+        be, so it is left to be looked at.
+
+        :param path: File in a destination.
+        :return: True if it is an unlocked partial copy, False otherwise.
+        """
+
+        if not re.fullmatch(r"\..+\.[0-9a-f]{16}\.part", path.name):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+        return True
+
+    def write_destination(self, dest, copy, index=0, resume=None):
+        """Write data to a temporary file and claim a destination name for it.
+
+        :param dest: Preferred destination path.
+        :param copy: Callable writing the data to the path it is given and returning
+            its hex digest, or None if verification failed. It also gets True if
+            the path is a partial copy that is kept if the copy is interrupted.
+        :param index: Collision index of the first name to try.
+        :param resume: Source file to keep a partial copy of if the copy is
+            interrupted, None to remove it.
+        :return: Destination path holding the data, None if verification failed.
+        """
+
+        partial = None if resume is None else self.partial_file(dest, resume)
+        if partial is None:
+            temp, lock = self.temp_file(dest), None
+        else:
+            temp, lock = partial
+
+        try:
+            try:
+                digest = copy(temp, lock is not None)
+            except BaseException:
+                if lock is None:
+                    temp.unlink(missing_ok=True)
+                raise
+            if digest is None:
+                temp.unlink(missing_ok=True)
+                return None
+
+            dest = self.claim_file(
+                temp, dest, lambda x: self.dest_hash(x) == digest, True, index
+            )
+        finally:
+            if lock is not None:
+                os.close(lock)
+        self.sync_file(dest)
+        if self.manifest:
+            self.record_hash(dest, digest)
+        self.record_catalog(dest, digest)
+        return dest
+
+    @staticmethod
+    def fsync_path(path):
+        """Flush a file, or the entries of a directory, to disk.
+
+        :param path: File or directory.
+        :return: None
+        """
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            # Some file systems can't sync directories
+            if not os.path.isdir(path) or e.errno not in (errno.EINVAL, errno.ENOTSUP):
+                raise
+        finally:
+            os.close(fd)
+
+    def sync_file(self, path):
+        """Make a written file and its directory entry durable, as `durability` asks.
+
+        The file is synced by the next `commit`.
+
+        :param path: File that was written or renamed.
+        :return: None
+        """
+
+        if self.durability == "none":
+            return
+
+        path = Path(path)
+        with self.sync_lock:
+            self.pending["files"].add(path)
+            # The month directory may be new too
+            self.pending["directories"].update((path.parent, path.parent.parent))
+            self.pending["bytes"] += path.stat().st_size
+
+    def remove_source(self, src):
+        """Delete a moved source file once its destination is durable.
+
+        :param src: Source file.
+        :return: None
+        """
+
+        if self.durability == "none":
+            Path(src).unlink()
+            return
+
+        with self.sync_lock:
+            self.pending["sources"].append(Path(src))
+
+    def count(self, key, amount=1):
+        """Add to one of the stats, from any thread.
+
+        :param key: Name of the stat.
+        :param amount: Amount to add.
+        :return: None
+        """
+
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def commit(self, force=True):
+        """Sync the files and directories written since the last commit, then
+        delete the sources waiting for them.
+
+        The catalog and ledger rows of the files are written in the same batches,
+        once the files are durable.
+
+        :param force: False to only commit once `sync_files` files or `sync_bytes`
+            bytes are waiting, unless durability is "strict".
+        :return: None
+        """
+
+        # Catalog and ledger rows waiting to be written
+        catalog = sum(len(x) for x in (self.catalog, self.ledger) if x is not None)
+        with self.sync_lock:
+            pending = self.pending
+            if (
+                not force
+                and self.durability != "strict"
+                and (
+                    len(pending["files"]) < self.sync_files
+                    and pending["bytes"] < self.sync_bytes
+                    and catalog < self.sync_files
+                )
+            ):
+                return
+            if not pending["files"] and not pending["sources"] and not catalog:
+                return
+
+            for path in sorted(pending["files"]):
+                self.fsync_path(path)
+            for path in sorted(pending["directories"], reverse=True):
+                self.fsync_path(path)
+            if self.catalog is not None:
+                self.catalog.commit()
+            if self.ledger is not None:
+                self.ledger.commit()
+            for src in pending["sources"]:
+                src.unlink(missing_ok=True)
+            if pending["files"]:
+                self.count("syncs")
+
+            self.pending = dict(files=set(), directories=set(), sources=[], bytes=0)
+
+    @staticmethod
+    def destination_name(dest, index):
+        """Get the name used for a destination after `index` collisions.
+
+        Names go `stem.suffix`, `stem-1.suffix`, `stem-2.suffix`...
+
+        :param dest: Preferred destination path.
+        :param index: Collision index, 0 for the preferred path.
+        :return: Destination path.
+        """
+
+        if index == 0:
+            return dest
+        return dest.parent / ("%s-%d%s" % (dest.stem, index, dest.suffix))
+
+    @classmethod
+    def find_destination(cls, dest, same_file, index=0):
+        """Find the first destination name that is unused or holds the same file.
+
+        :param dest: Preferred destination path.
+        :param same_file: Callable returning True if a destination path holds the source data.
+        :param index: Collision index of the first name to try.
+        :return: Collision index of the destination name.
+        """
+
+        while True:
+            candidate = cls.destination_name(dest, index)
+            if not candidate.exists() or same_file(candidate):
+                return index
+            index += 1
+
+    def move_file(self, src_file, dest_file, move=False, dryrun=False, index=0):
+        """Move or copy a file from the src to the dest.
+
+        :param src_file: Source path.
+        :param dest_file: Destination path.
+        :param move: True to move files, False to copy them.
+        :param dryrun: If True then files will not be copied or moved.
+        :param index: Collision index of the first destination name to try.
+        :return: None
+        """
+
+        if self.storage is not None:
+            return self.store_file(src_file, dest_file, move, dryrun, index)
+
+        src = Path(src_file)
+        base = Path(dest_file)
+        dest = self.destination_name(base, index)
+
+        if not self.is_file(src):
+            return False
+        if dest.exists():
+            if not self.is_file(dest):
+                return False
+            elif not dryrun:
+                index = self.find_destination(
+                    base, lambda candidate: self.diff_files(src, candidate), index
+                )
+                dest = self.destination_name(base, index)
+
+        if dryrun:
+            self.log["processed"].append(f"{src} -> {dest}")
+            return True
+
+        if dest.exists():
+            # The same data is already in the destination
+            self.count("duplicates")
+            self.queue_thumbnail(dest)
+            self.record_catalog(dest)
+            if move:
+                self.remove_source(src)
+                self.commit(force=False)
+            return True
+
+        self.ops_limit.consume(1)
+
+        def copy(temp, resumable):
+            return self.copy_file(src, temp, resumable)
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if move:
+            with self.span("move", "copy", src):
+                moved = self.claim_file(
+                    src, base, lambda x: self.diff_files(src, x), False, index, True
+                )
+            if moved:
+                # The data was already on disk, only the directory entry is new
+                self.sync_file(moved)
+                if self.manifest:
+                    # Nothing was copied so the hash is taken here, for the manifest
+                    self.dest_hash(moved)
+                else:
+                    self.record_catalog(moved)
+                self.remove_source(src)
+                self.commit(force=False)
+                self.count("moved")
+                self.queue_thumbnail(moved)
+                return True
+            # Different file systems, fall back to copy and delete
+
+        resume = src if src.stat().st_size >= self.resume_size else None
+        with self.span("copy", "copy", src):
+            written = self.write_destination(base, copy, index, resume)
+        if written is None:
+            self.log["verify"].append((src, dest))
+            return False
+        self.count("copied")
+        self.count("bytes", src.stat().st_size)
+        self.queue_thumbnail(written)
+        if move:
+            self.remove_source(src)
+        self.commit(force=False)
+
+        return True
+
+    def move_member(self, archive, name, dest_file, dryrun=False):
+        """Copy an archive member to the dest.
+
+        :param archive: Archive holding the member.
+        :param name: Member name.
+        :param dest_file: Destination path.
+        :param dryrun: If True then the member will not be copied.
+        :return: True if copied or already in the destination, False otherwise.
+        """
+
+        if self.storage is not None:
+            if dryrun:
+                self.log["processed"].append(f"{archive.path / name} -> {dest_file}")
+                return True
+            self.ops_limit.consume(1)
+            self.store_stream(
+                archive.path / name,
+                lambda: archive.open(name),
+                archive.size(name),
+                dest_file,
+            )
+            return True
+
+        base = Path(dest_file)
+        dest = base
+        index = 0
+        src_hash = list()
+
+        def same_file(candidate):
+            if candidate.stat().st_size != archive.size(name):
+                return False
+            if not src_hash:
+                with archive.open(name) as file_in:
+                    src_hash.append(self.hash_stream(file_in))
+            return src_hash[0] == self.dest_hash(candidate)
+
+        if dest.exists():
+            if not self.is_file(dest):
+                return False
+            elif not dryrun:
+                index = self.find_destination(base, same_file)
+                dest = self.destination_name(base, index)
+
+        if dryrun:
+            self.log["processed"].append(f"{archive.path / name} -> {dest}")
+            return True
+        if dest.exists():
+            self.count("duplicates")
+            self.queue_thumbnail(dest)
+            self.record_catalog(dest)
+            return True
+
+        self.ops_limit.consume(1)
+
+        def copy(temp, resumable):
+            return self.copy_member(archive, name, temp)
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with self.span(
+            "copy",
+            "copy",
+            path=None,
+            member=str(archive.path / name),
+            size=archive.size(name),
+            suffix=base.suffix,
+        ):
+            written = self.write_destination(base, copy, index)
+        if written is None:
+            self.log["verify"].append((archive.path / name, dest))
+            return False
+        self.count("copied")
+        self.count("bytes", archive.size(name))
+        self.queue_thumbnail(written)
+        self.commit(force=False)
+
+        return True
+
+    def store_file(self, src_file, dest_file, move=False, dryrun=False, index=0):
+        """Move or copy a file from the src into the destination storage.
+
+        :param src_file: Source path.
+        :param dest_file: Destination key.
+        :param move: True to delete the source once it is stored.
+        :param dryrun: If True then files will not be copied or moved.
+        :param index: Collision index of the first destination name to try.
+        :return: True if stored or already in the destination, False otherwise.
+        """
+
+        src = Path(src_file)
+        if not self.is_file(src):
+            return False
+        if dryrun:
+            self.log["processed"].append(
+                f"{src} -> {self.destination_name(PurePosixPath(dest_file), index)}"
+            )
+            return True
+
+        self.ops_limit.consume(1)
+        self.store_stream(
+            src, lambda: open(src, "rb"), src.stat().st_size, dest_file, index
+        )
+        if move:
+            self.remove_source(src)
+            self.commit(force=False)
+        return True
+
+    def store_stream(self, src, open_source, size, dest_file, index=0):
+        """Store data under the first free destination key, or find it already stored.
+
+        The source is hashed first, the hash is stored as metadata of the object so
+        later collisions can be checked without reading the object back.
+
+        :param src: Source path, for the logs.
+        :param open_source: Callable returning a new binary file object of the data.
+        :param size: Size of the data in bytes.
+        :param dest_file: Preferred destination key.
+        :param index: Collision index of the first name to try.
+        :return: Destination key holding the data.
+        """
+
+        base = PurePosixPath(dest_file)
+        src_hash = list()
+
+        def digest():
+            if not src_hash:
+                with open_source() as file_in:
+                    src_hash.append(self.hash_stream(file_in))
+            return src_hash[0]
+
+        while True:
+            dest = self.destination_name(base, index)
+            if self.stored_file(dest, size, digest) is None:
+                metadata = {self.hash_algorithm: digest()}
+                with open_source() as file_in, self.span(
+                    "upload", "copy", path=None, src=str(src), size=size
+                ):
+                    file_in = LimitedReader(file_in, self.write_limit)
+                    stored = self.storage.put(dest.as_posix(), file_in, size, metadata)
+                if stored:
+                    self.count("copied")
+                    self.count("bytes", size)
+                    return dest
+                # Another writer took the name first, see what it holds
+                continue
+            if self.stored_file(dest, size, digest):
+                self.count("duplicates")
+                return dest
+            index += 1
+
+    def stored_file(self, dest, size, digest):
+        """Check whether a destination key is free or holds the source data.
+
+        :param dest: Destination key.
+        :param size: Size of the source data.
+        :param digest: Callable returning the hex digest of the source data.
+        :return: None if the key is free, else True if it holds the data.
+        """
+
+        info = self.storage.stat(PurePosixPath(dest).as_posix())
+        if info is None:
+            return None
+        if info.size != size:
+            return False
+        stored = info.metadata.get(self.hash_algorithm)
+        if stored is None:
+            with self.storage.open(PurePosixPath(dest).as_posix()) as file_in:
+                stored = self.hash_stream(file_in)
+        return stored == digest()
+
+    def thumbnail_path(self, dest_file, dest_path=None):
+        """Get the path of the preview of a sorted file.
+
+        Previews go in `<dest>/.thumbnails/`, in the same directories as the files
+        below the destination, and are always JPEG files.
+
+        :param dest_file: Sorted file.
+        :param dest_path: Destination root, None to go up as many directories as
+            `layout` has.
+        :return: Path
+        """
+
+        dest_file = Path(dest_file)
+        name = dest_file.name
+        if dest_file.suffix.lower() not in (".jpg", ".jpeg"):
+            name += ".jpg"
+        if dest_path is not None:
+            root = Path(dest_path)
+        else:
+            root = dest_file.parents[self.layout.count("/") + 1]
+        return root / ".thumbnails" / dest_file.parent.relative_to(root) / name
+
+    def queue_thumbnail(self, dest_file):
+        """Make a preview of a sorted file on the thumbnail process pool.
+
+        Nothing is done unless `thumbnails` is set, or if the preview is up to date.
+
+        :param dest_file: Sorted file.
+        :return: None
+        """
+
+        dest_file = Path(dest_file)
+        if (
+            not self.thumbnails
+            or dest_file.suffix.lower() not in self.thumbnail_suffixes
+        ):
+            return
+
+        thumbnail = self.thumbnail_path(dest_file)
+        try:
+            if thumbnail.stat().st_mtime_ns == dest_file.stat().st_mtime_ns:
+                self.count("thumbnails_current")
+                return
+        except FileNotFoundError:
+            pass
+
+        workers = os.cpu_count() or 1
+        with self.pool_lock:
+            if self.thumbnail_pool is None:
+                self.thumbnail_pool = ProcessPoolExecutor(workers)
+            waiting = len(self.thumbnail_jobs)
+        # Keep a bounded number of previews waiting so memory use stays flat
+        if waiting >= 4 * workers:
+            self.finish_thumbnails(waiting // 2)
+        job = self.thumbnail_pool.submit(
+            run_in_worker,
+            make_thumbnail,
+            (str(dest_file), str(thumbnail), self.thumbnail_size),
+            self.tracer is not None,
+            self.profiler is not None,
+        )
+        with self.pool_lock:
+            self.thumbnail_jobs.append(job)
+
+    def finish_thumbnails(self, count=None):
+        """Wait for queued previews and count the results.
+
+        :param count: Number of the oldest previews to wait for, None for all of them.
+        :return: None
+        """
+
+        with self.pool_lock:
+            if count is None:
+                count = len(self.thumbnail_jobs)
+            jobs, self.thumbnail_jobs = (
+                self.thumbnail_jobs[:count],
+                self.thumbnail_jobs[count:],
+            )
+        for job in jobs:
+            result, events, stats = job.result()
+            if self.tracer is not None:
+                self.tracer.events.extend(events)
+            if stats is not None and self.profiler is not None:
+                self.profiler.process_stats.append(stats)
+            if result:
+                self.count("thumbnails")
+            else:
+                self.count("thumbnail_errors")
+
+    def verify_library(self, dest_path, checkpoint=None):
+        """Re-hash the files of a sorted library and compare them with the manifests.
+
+        Files that no longer match are logged as bitrot, manifest entries without a
+        file as missing and files without a manifest entry as unexpected.
+
+        :param dest_path: Destination path to check.
+        :param checkpoint: File listing the directories already checked, they are
+            skipped. It is removed once the whole library has been checked.
+        :return: None
+        """
+
+        dest_path = Path(dest_path)
+        done = set()
+        if checkpoint is not None and Path(checkpoint).is_file():
+            done = set(Path(checkpoint).read_text().splitlines())
+
+        directories = list()
+        for root, dirs, files in os.walk(dest_path):
+            dirs[:] = sorted(x for x in dirs if x not in self.ignore)
+            directories.append(Path(root))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for directory in tqdm(directories):
+                key = directory.relative_to(dest_path).as_posix()
+                if key in done:
+                    continue
+                self.verify_directory(directory, pool)
+                if checkpoint is not None:
+                    with open(checkpoint, "a") as out_file:
+                        out_file.write(key + "\n")
+
+        if checkpoint is not None:
+            Path(checkpoint).unlink(missing_ok=True)
+
+    def verify_directory(self, directory, pool):
+        """Check the files in one directory against its manifest.
+
+        :param directory: Directory to check.
+        :param pool: Executor the files are hashed on.
+        :return: None
+        """
+
+        self.manifests.pop(directory, None)
+        hashes = self.load_manifest(directory)
+
+        files = list()
+        for path in sorted(directory.iterdir()):
+            if path.name in self.ignore or not self.is_file(path):
+                continue
+            if path.name.startswith(".") and path.name.endswith(".part"):
+                if self.stale_partial(path):
+                    self.log["partials"].append(path)
+                continue
+            if path.name in hashes:
+                files.append(path)
+            else:
+                self.log["unexpected"].append(path)
+
+        names = {x.name for x in files}
+        for name in sorted(set(hashes) - names):
+            self.log["missing"].append(directory / name)
+
+        for path, digest in zip(files, pool.map(self.profiled(self.hash_file), files)):
+            self.count("verified")
+            if digest != hashes[path.name]:
+                self.log["bitrot"].append(path)
+
+    def compact_library(self, dest_path, dryrun=False):
+        """Replace identical files in a sorted library with links to one copy.
+
+        Files are bucketed by size first and only buckets with more than one file
+        are hashed, on a pool of `workers` threads. Names that are already hard
+        links of each other count as one file.
+
+        :param dest_path: Destination path to compact.
+        :param dryrun: If True only log the duplicates and count the bytes.
+        :return: None
+        """
+
+        table = self.scan_directory(dest_path)
+        buckets = dict()
+        for row in range(len(table)):
+            name = table.name(row)
+            if name.startswith(".") and name.endswith(".part"):
+                if self.stale_partial(table.path(row)):
+                    self.log["partials"].append(table.path(row))
+                continue
+            if table.sizes[row]:
+                buckets.setdefault(table.sizes[row], list()).append(row)
+
+        files = dict()
+        for size, rows in buckets.items():
+            if len(rows) < 2:
+                continue
+            for row in rows:
+                path = table.path(row)
+                try:
+                    info = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    key = (info.st_dev, size)
+                    files.setdefault(key, dict()).setdefault(info.st_ino, list())
+                    files[key][info.st_ino].append((path, info.st_mtime_ns))
+
+        # One path of each inode is enough to hash
+        inodes = [
+            (key, inode, paths)
+            for key, by_inode in files.items()
+            if len(by_inode) > 1
+            for inode, paths in by_inode.items()
+        ]
+        groups = dict()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            digests = pool.map(
+                self.profiled(self.hash_file), [x[2][0][0] for x in inodes]
+            )
+            for (key, inode, paths), digest in zip(tqdm(inodes), digests):
+                groups.setdefault((key, digest), list()).append(paths)
+
+        for (key, digest), copies in sorted(groups.items()):
+            if len(copies) < 2:
+                continue
+            # Keep the copy with the most names, then the shortest name
+            copies.sort(key=lambda x: (-len(x), min(len(p.name) for p, _ in x), x))
+            keep, keep_mtime = copies[0][0]
+            info = os.lstat(keep)
+            if (info.st_size, info.st_mtime_ns) != (key[1], keep_mtime):
+                # Changed while the group was hashed, the hash may not be of this data
+                self.count("compact_changed")
+                continue
+            self.count("compact_groups")
+            for paths in copies[1:]:
+                self.count("compact_bytes", key[1])
+                for path, mtime in paths:
+                    self.log["compact"].append((path, keep))
+                    if not dryrun:
+                        self.link_duplicate(keep, path, key[1], mtime, keep_mtime)
+        self.commit()
+
+    def link_duplicate(self, keep, duplicate, size, mtime, keep_mtime):
+        """Replace a file with a reflink of, or else a hard link to, an identical file.
+
+        The new name is made next to the duplicate and renamed over it, so the
+        duplicate's name always holds the data. If either file changed since they
+        were hashed, before or while the link is made, the duplicate is left alone.
+
+        :param keep: File to keep.
+        :param duplicate: File holding the same data, to be replaced.
+        :param size: Size of the files when they were hashed.
+        :param mtime: mtime of the duplicate in ns when it was hashed.
+        :param keep_mtime: mtime of the file to keep in ns when it was hashed.
+        :return: None
+        """
+
+        def unchanged(info, expected_mtime):
+            return (info.st_size, info.st_mtime_ns) == (size, expected_mtime)
+
+        if not unchanged(os.lstat(duplicate), mtime) or not unchanged(
+            os.lstat(keep), keep_mtime
+        ):
+            self.count("compact_changed")
+            return
+
+        temp = self.temp_file(Path(duplicate))
+        try:
+            try:
+                with open(keep, "rb") as file_in, open(temp, "wb") as file_out:
+                    fcntl.ioctl(file_out.fileno(), self.ficlone, file_in.fileno())
+                    kept = os.fstat(file_in.fileno())
+                    made = os.fstat(file_out.fileno())
+                shutil.copystat(duplicate, temp)
+                method = "compact_reflinked"
+            except (OSError, AttributeError):
+                # No reflinks on this file system, or no fcntl
+                temp.unlink()
+                os.link(keep, temp)
+                kept = made = os.stat(temp)
+                method = "compact_linked"
+            if (
+                not unchanged(kept, keep_mtime)
+                or made.st_size != size
+                or not unchanged(os.lstat(duplicate), mtime)
+            ):
+                temp.unlink()
+                self.count("compact_changed")
+                return
+            os.replace(temp, duplicate)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        self.count(method)
+        self.sync_file(duplicate)
+
+    @staticmethod
+    def check_layout(layout):
+        """Check that a layout builds directories below the destination.
+
+        :param layout: strftime format such as %Y/%Y-%m.
+        :raises ValueError: If it doesn't.
+        """
+
+        parts = layout.split("/")
+        if "%" not in layout or any(x in ("", ".", "..") for x in parts):
+            raise ValueError(f"Bad layout {layout}")
+
+    def read_layout(self, dest_path):
+        """Read the layout a library was last laid out with.
+
+        :param dest_path: Destination path.
+        :return: strftime format, None if not recorded.
+        """
+
+        try:
+            return (Path(dest_path) / self.layout_name).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def relayout_library(self, dest_path, layout, dryrun=False):
+        """Move the files of a sorted library into a new layout with renames only.
+
+        The new path of each file comes from the timestamp in its name. Only files
+        as deep as the current layout puts them are moved, others are counted as
+        `relayout_skipped` and left alone. Files are
+        moved in batches of `sync_files`, each written to a journal first and
+        committed, with the manifests of the directories they left, before the next.
+        An interrupted relayout is finished by running it again, which first
+        replays the journal.
+
+        :param dest_path: Destination path.
+        :param layout: New strftime format of the directories.
+        :param dryrun: If True only log the moves.
+        :return: None
+        """
+
+        dest_path = Path(dest_path)
+        old_layout = self.read_layout(dest_path) or "%Y-%m"
+        journal = dest_path / self.journal_name
+        if self.catalog is None and (dest_path / Catalog.name).exists():
+            self.open_catalog(dest_path)
+        directories = set()
+        if journal.exists() and not dryrun:
+            self.count("relayout_resumed")
+            directories = self.replay_journal(journal)
+
+        depth = old_layout.count("/") + 2
+        table = self.scan_directory(dest_path)
+        moves = list()
+        for row in range(len(table)):
+            name = table.name(row)
+            if name.startswith(".") and name.endswith(".part"):
+                continue
+            if len(table.path(row).relative_to(dest_path).parts) != depth:
+                if not name.startswith("."):
+                    self.count("relayout_skipped")
+                continue
+            d = self.get_date_from_filename(name)
+            if d is None:
+                self.log["parse"].append(table.path(row))
+                continue
+            dest = dest_path / d.strftime(layout) / name
+            if dest != table.path(row):
+                moves.append((table.path(row), dest))
+
+        if dryrun:
+            for src, dest in moves:
+                self.log["processed"].append(f"{src} -> {dest}")
+            return
+
+        for number, start in enumerate(range(0, len(moves), self.sync_files)):
+            batch = moves[start : start + self.sync_files]
+            self.write_journal(
+                journal,
+                {"batch": number, "moves": [[str(x), str(y)] for x, y in batch]},
+            )
+            left = set()
+            for src, dest in tqdm(batch):
+                self.relayout_file(src, dest, dest_path)
+                left.add(src.parent)
+                left.add(self.thumbnail_path(src, dest_path).parent)
+            for directory in left:
+                self.write_manifest(directory)
+            directories.update(left)
+            self.commit()
+            self.write_journal(journal, {"batch": number, "done": True})
+
+        for directory in sorted(directories, reverse=True):
+            # Remove the directories of the old layout that are now empty
+            while directory != dest_path and dest_path in directory.parents:
+                try:
+                    directory.rmdir()
+                except OSError:
+                    break
+                directory = directory.parent
+        (dest_path / self.layout_name).write_text(layout + "\n")
+        if self.catalog is not None:
+            self.catalog.commit()
+        journal.unlink(missing_ok=True)
+
+    def relayout_file(self, src, dest, dest_path):
+        """Rename one file of a library to its path in a new layout.
+
+        If the new name is taken by other data the file gets the next free `-N`
+        name. If it is taken by the same data, going by the manifests when there
+        are any, the file is removed.
+
+        :param src: Current path of the file.
+        :param dest: New path of the file.
+        :param dest_path: Destination path, for the previews.
+        :return: None
+        """
+
+        match = re.fullmatch(r"(.*)-(\d+)", dest.stem)
+        base, index = dest, 0
+        if match is not None:
+            base = dest.with_name(match.group(1) + dest.suffix)
+            index = int(match.group(2))
+
+        digest = self.load_manifest(src.parent).get(src.name)
+        inode = src.stat().st_ino
+
+        def known_hash(path):
+            return self.load_manifest(path.parent).get(path.name) or self.dest_hash(
+                path
+            )
+
+        def same_file(candidate):
+            return candidate.stat().st_size == src.stat().st_size and (
+                known_hash(candidate) == known_hash(src)
+            )
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        moved = self.claim_file(src, base, same_file, True, index)
+        self.sync_file(moved)
+        self.load_manifest(src.parent).pop(src.name, None)
+        if self.catalog is not None:
+            self.catalog.remove(src)
+
+        thumbnail = self.thumbnail_path(src, dest_path)
+        if moved.stat().st_ino != inode:
+            # The same data was already there
+            self.count("relayout_duplicates")
+            thumbnail.unlink(missing_ok=True)
+            return
+
+        self.count("relayout_moved")
+        if digest is not None:
+            self.record_hash(moved, digest)
+        self.record_catalog(moved, digest)
+        if thumbnail.exists():
+            new_thumbnail = self.thumbnail_path(moved, dest_path)
+            new_thumbnail.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(thumbnail, new_thumbnail)
+
+    def replay_journal(self, journal):
+        """Tidy up after a relayout that was interrupted part way through a batch.
+
+        Files of the journal that are gone from their old paths were moved, so they
+        are taken out of the manifests, and the catalog, they left. The new paths
+        already have their manifest entries.
+
+        :param journal: Journal of the interrupted relayout, in the destination.
+        :return: set of the directories files were moved out of.
+        """
+
+        directories = set()
+        with open(journal) as in_file:
+            for line in in_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by the interruption, its batch never started
+                    continue
+                for src, dest in entry.get("moves", list()):
+                    src, dest = Path(src), Path(dest)
+                    directories.add(src.parent)
+                    directories.add(self.thumbnail_path(src, journal.parent).parent)
+                    if os.path.lexists(src):
+                        continue
+                    self.load_manifest(src.parent).pop(src.name, None)
+                    if self.catalog is not None:
+                        self.catalog.remove(src)
+                        if dest.exists():
+                            self.record_catalog(dest)
+        for directory in directories:
+            self.write_manifest(directory)
+        return directories
+
+    @staticmethod
+    def write_journal(journal, entry):
+        """Append an entry to a journal and flush it to disk.
+
+        :param journal: Journal file.
+        :param entry: JSON serialisable entry.
+        :return: None
+        """
+
+        with open(journal, "a") as out_file:
+            out_file.write(json.dumps(entry) + "\n")
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+    def write_manifest(self, directory):
+        """Rewrite the manifest of a directory from the loaded hashes.
+
+        Nothing is done if the directory has no manifest. It is removed once it
+        has no entries.
+
+        :param directory: Directory holding the manifest.
+        :return: None
+        """
+
+        manifest = Path(directory) / self.manifest_name
+        if not manifest.exists():
+            return
+        hashes = self.load_manifest(directory)
+        if not hashes:
+            manifest.unlink()
+            return
+        temp = self.temp_file(manifest)
+        with open(temp, "w") as out_file:
+            for name, digest in sorted(hashes.items()):
+                out_file.write(f"{digest}  {name}\n")
+        os.replace(temp, manifest)
+        self.sync_file(manifest)
+
+    def get_prefix(self, path):
+        """Get the destination name prefix for a file.
+
+        :param path: Path of the file.
+        :return: "IMG_" or "VID_", None if the suffix is unknown.
+        """
+
+        suffix = path.suffix.lower()
+        if suffix in self.image_suffixes:
+            return "IMG_"
+        elif suffix in self.video_suffixes:
+            return "VID_"
+        return None
+
+    @staticmethod
+    def get_destination(dest_path, prefix, file_timestamp, suffix, layout="%Y-%m"):
+        """Build the destination path of a file.
+
+        :param dest_path: Destination root.
+        :param prefix: File name prefix.
+        :param file_timestamp: Timestamp of the file.
+        :param suffix: Suffix of the source file.
+        :param layout: strftime format of the directories below the root.
+        :return: Path
+        """
+
+        return (
+            Path(dest_path)
+            / file_timestamp.strftime(layout)
+            / (prefix + file_timestamp.strftime("%Y%m%d_%H%M%S") + suffix.lower())
+        )
+
+    def get_date(
+        self, group, exif=False, google_json_date=False, archive=None, prefetched=None
+    ):
+        """Work out the timestamp of a capture, logging each method that fails.
+
+        The files of the capture are tried in order and the first timestamp found
+        is used for all of them.
+
+        :param group: list of paths of the files, or member names if they are in an archive.
+        :param exif: True to look for exif data to get datetime stamp.
+        :param google_json_date: True to look for Google JSON files with image data.
+        :param archive: Archive holding the files, None for files on disk.
+        :param prefetched: What `prefetch_groups` read ahead for the capture, None if nothing.
+        :return: datetime.datetime, None if no timestamp was found.
+        """
+
+        log_paths = group if archive is None else [archive.path / x for x in group]
+        headers = dict() if prefetched is None else prefetched.headers
+        files = None if prefetched is None else prefetched.files
+
+        if exif:
+            for src in group:
+                if archive is None and headers.get(src) is not None:
+                    d = self.get_date_from_metadata(src, headers[src], False)
+                elif archive is None:
+                    d = self.get_date_from_metadata(src)
+                else:
+                    # Only the start of the member is read
+                    d = self.get_date_from_metadata(
+                        src, archive.read(str(src), self.header_size)
+                    )
+                if d is not None:
+                    return d
+            self.log["exif"].extend(log_paths)
+
+        if google_json_date:
+            for src in group:
+                d = self.get_google_json_date(src, archive, files)
+                if d is not None:
+                    return d
+            self.log["google_json_date"].extend(log_paths)
+
+        for src in group:
+            d = self.get_date_from_filename(src.name)
+            if d is not None:
+                return d
+        self.log["parse"].extend(log_paths)
+        return None
+
+    def capture_key(self, path):
+        """Get the directory and name, without suffixes, of a capture.
+
+        :param path: Path of one of the capture's files.
+        :return: tuple of the parent directory and stem.
+        """
+
+        return path.parent, self.capture_stem(path.name)
 
-        return parser
+    def capture_stem(self, name):
+        """Strip the image suffixes from a file name.
 
-    @classmethod
-    def get_date_from_video(cls, filename):
-        """Extract the date from a video file using ffprobe."""
-        result = subprocess.run(["ffprobe", filename], capture_output=True)
-        stdout = result.stdout.decode(encoding="utf-8")
-        stderr = result.stderr.decode(encoding="utf-8")
-        if result.returncode:
-            return None
+        :param name: File name.
+        :return: str
+        """
 
-        for timestamp in [
-            x.strip() for x in stderr.split("\n") if "creation_time" in x
-        ]:
-            entry = timestamp.split(":", 1)
-            if len(entry) != 2:
-                continue
-            t = entry[1].strip()
-            if "Z" in t:
-                t = t.replace("Z", "+00:00")
-            try:
-                r = datetime.fromisoformat(t)
-            except ValueError:
-                print(f"File {filename} with timestamp {t}")
-                continue
-            return r
-        return None
+        stem = name
+        while PurePosixPath(stem).suffix.lower() in self.image_suffixes:
+            stem = PurePosixPath(stem).stem
+        return stem
 
-    @classmethod
-    def get_google_json_date(cls, filename):
-        """Extract the image creation date from Google Photos JSON file.
+    def in_shard(self, path, src_path=None):
+        """Check if a file belongs to the shard this run is sorting.
 
-        :param filename: Filename of the JSON file to load.
-        :return: datetime.datetime
+        Files are assigned by a CRC-32 of their path relative to the source, with the
+        suffixes dropped so all files of a capture end up in the same shard.
+
+        :param path: Path of the file.
+        :param src_path: Source path the file was found in.
+        :return: True if there is no shard or the file is in it, False otherwise.
         """
 
-        if filename.name != "sp-n-mobo-c (1).jpg":
-            return None
+        if self.shard is None:
+            return True
 
-        matches = re.search("\(\d+\)", filename.name)
-        if not matches:
-            json_filename = filename.parent / Path(filename.name + ".json")
-        elif matches.group(0):
-            filename_nameonly = filename.stem.split("(", 1)
-            if len(filename_nameonly) < 2:
-                return None
-            filename_nameonly = filename_nameonly[0]
-            json_filename = filename.parent / Path(
-                filename_nameonly + filename.suffix + matches.group(0) + ".json"
-            )
+        parent, stem = self.capture_key(path)
+        if src_path is not None:
+            parent = parent.relative_to(src_path)
+        if self.shard_by == "dir" and parent.parts:
+            key = parent.parts[0]
         else:
-            return None
+            key = (parent / stem).as_posix()
 
-        # Need to check for the same name, no changes, just json appeneded even though (\d+) in it
+        index, count = self.shard
+        return zlib.crc32(key.encode("utf-8")) % count == index - 1
 
-        if not json_filename.is_file():
-            # Try alternate form
-            json_filename = filename.parent / Path(filename.name + ".json")
-            if not json_filename.is_file():
-                return None
+    def group_files(self, files, table=None):
+        """Group the files that belong to one capture.
 
-        with open(json_filename) as in_file:
-            try:
-                data = json.load(in_file)
-            except UnicodeDecodeError:
-                return None
+        Files in the same directory with the same name apart from the suffixes are
+        one capture, for example `DSC_0001.NEF`, `DSC_0001.JPG` and `DSC_0001.NEF.xmp`.
 
-            return datetime.fromtimestamp(int(data["photoTakenTime"]["timestamp"]))
+        :param files: list of image file paths, or rows of `table`.
+        :param table: FileTable the rows are from, None if files are paths.
+        :return: list of groups, each a list of paths, or rows, in `group_order`.
+        """
 
-    @classmethod
-    def get_date_from_exif(cls, filename):
-        """Get the timestamp from the file's exif data.
+        if table is None:
 
-        :param filename: Filename of the image file.
-        :return: datetime.datetime
-        """
-        try:
-            exif = Image.open(filename).getexif()
-        except UnidentifiedImageError:
-            return None
-        timestamp = exif.get(306)
-        if timestamp is None:
-            return None
-        try:
-            return datetime.strptime(timestamp, "%Y:%m:%d %H:%M:%S")
-        except ValueError:
-            raise
+            def suffix_of(src):
+                return src.suffix.lower()
 
-    @classmethod
-    def get_date_from_xmp(cls, filename):
-        """Get the timestamp from the file's exif xmp data.
+            def key_of(src):
+                return self.capture_key(src)
 
-        :param filename: Filename of the image file.
-        :return: datetime.datetime
-        """
-        try:
-            with Image.open(filename) as img:
-                if not hasattr(img, "applist"):
-                    return None
-                for segment, content in img.applist:
-                    if b"\x00" not in content:
-                        continue
-                    marker, body = content.split(b"\x00", 1)
-                    if segment == "APP1" and marker == b"http://ns.adobe.com/xap/1.0/":
-                        body = body.decode("utf-8")
-                        pattern = re.compile(
-                            'exif:DateTimeOriginal="(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\+\d{2}:\d{2})'
-                        )
-                        timestamp = pattern.search(body)
-                        if timestamp is None:
-                            continue
-                        timestamp = timestamp.group(1)
-                        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
-        except UnidentifiedImageError:
-            pass
-        return None
+        else:
 
-    @classmethod
-    def get_date_from_filename(cls, filename):
-        """Derive the images timestamp from the filename.
+            def suffix_of(src):
+                return table.suffix(src).lower()
 
-        :param filename: Filename of the image file.
-        :return: datetime.datetime
-        """
-        f = cls.date_replace.sub("_", str(filename))
-        match = cls.date_pattern.search(f)
-        if match is None:
-            return None
+            def key_of(src):
+                return table.parents[src], self.capture_stem(table.name(src))
 
-        try:
-            return datetime.strptime(match.group(0), "%Y%m%d_%H%M%S")
-        except ValueError:
-            return None
+        groups = dict()
+        singles = list()
+        for src in files:
+            group = groups.setdefault(key_of(src), list())
+            if suffix_of(src) in {suffix_of(x) for x in group}:
+                # Would end up with the same destination name as another member
+                singles.append([src])
+            else:
+                group.append(src)
 
-    def search_directory(self, sp):
-        """Return the contents of a directory.
+        def rank(src):
+            suffix = suffix_of(src)
+            if suffix in self.group_order:
+                return self.group_order.index(suffix)
+            return len(self.group_order)
 
-        :param sp: Path to search.
-        :return: list of directory contents.
-        """
+        return [sorted(x, key=rank) for x in groups.values()] + singles
 
-        return [x for x in Path(sp).rglob("*") if not set(x.parts) & self.ignore]
+    def prefetch_groups(self, groups, exif=False, google_json_date=False):
+        """Read ahead what finding the timestamps of the next captures needs.
 
-    @staticmethod
-    def is_file(file_path):
-        """Check if the path is a file or something else.
+        The headers of the files, with `exif`, and the Google JSON files that exist,
+        with `google_json_date`, of the next `prefetch` captures are requested at
+        once, so on network mounts the round trips overlap.
 
-        :param file_path: Path to check.
-        :return: True if it is a file, False otherwise.
+        :param groups: Iterable of captures, lists of paths.
+        :param exif: True if metadata will be read.
+        :param google_json_date: True if Google JSON files will be looked for.
+        :return: Iterator of (capture, SimpleNamespace of headers and files, or None).
         """
 
-        p = Path(file_path)
+        if not self.prefetch or not (exif or google_json_date):
+            for group in groups:
+                yield group, None
+            return
 
-        if p.is_symlink():
-            return False
-        elif p.is_file():
-            return True
-        elif p.is_dir():
-            return False
-        else:
-            return False
+        def results(futures):
+            return {path: future.result() for path, future in futures.items()}
 
-    def diff_files(self, src_file, dest_file):
-        """Hash two files and see if they are the same or not.
+        prefetcher = Prefetcher(self.prefetch, self.header_size)
+        pending = deque()
+        try:
+            for group in groups:
+                headers = dict()
+                files = dict()
+                for src in group:
+                    if exif:
+                        headers[src] = prefetcher.header(src)
+                    if google_json_date:
+                        for path in self.google_json_names(src):
+                            files[path] = prefetcher.is_file(path)
+                pending.append((group, headers, files))
+                if len(pending) > self.prefetch:
+                    group, headers, files = pending.popleft()
+                    yield group, SimpleNamespace(
+                        headers=results(headers), files=results(files)
+                    )
+            while pending:
+                group, headers, files = pending.popleft()
+                yield group, SimpleNamespace(
+                    headers=results(headers), files=results(files)
+                )
+        finally:
+            prefetcher.close()
 
-        :param src_file: Source file.
-        :param dest_file: Destination file.
-        :return: True if hash matches, False if different.
+    def run_stages(self, groups, extract, store, progress):
+        """Find the timestamps of captures and copy them on two pools of workers,
+        each sized by an `Autotuner`.
+
+        The extract stage is measured in files and the copy stage in bytes, so each
+        settles on the worker count its device does best with. Captures are copied
+        as soon as their timestamps are found, so their order can change.
+
+        :param groups: Iterable of (capture, prefetched).
+        :param extract: Function of a capture and its prefetched data, giving the
+            arguments for `store` or None to skip the capture.
+        :param store: Function copying a capture.
+        :param progress: tqdm progress bar.
+        :return: None
         """
 
-        src_hash, dest_hash = hashlib.sha512(), hashlib.sha512()
+        tuners = [
+            Autotuner("extract", *self.extract_workers, self.autotune_window),
+            Autotuner("copy", *self.copy_workers, self.autotune_window),
+        ]
+        extract_tuner, copy_tuner = tuners
+        # Captures between the two stages, bounded so the scan can't run far ahead
+        window = threading.BoundedSemaphore(2 * (extract_tuner.high + copy_tuner.high))
 
-        with open(src_file, "rb") as file_in:
-            for block in iter(lambda: file_in.read(4096), b""):
-                src_hash.update(block)
+        def copy(group, found):
+            try:
+                size = 0
+                for src in group:
+                    with contextlib.suppress(OSError):
+                        size += os.stat(src).st_size
+                with copy_tuner.slot(size):
+                    store(group, *found)
+            finally:
+                window.release()
 
-        with open(dest_file, "rb") as file_in:
-            for block in iter(lambda: file_in.read(4096), b""):
-                dest_hash.update(block)
+        def find(group, prefetched):
+            try:
+                with extract_tuner.slot(len(group)):
+                    found = extract(group, prefetched)
+            except BaseException:
+                window.release()
+                raise
+            if found is None:
+                window.release()
+                return None
+            return copy_pool.submit(copy, group, found)
 
-        return src_hash.hexdigest() == dest_hash.hexdigest()
+        def collect(wait):
+            # The copies of finished extracts join the queue, so errors surface
+            while futures and (wait or futures[0].done()):
+                copied = futures.popleft().result()
+                if copied is not None:
+                    futures.append(copied)
 
-    def move_file(self, src_file, dest_file, move=False, dryrun=False):
-        """Move or copy a file from the src to the dest.
+        futures = deque()
+        extract_pool = ThreadPoolExecutor(max_workers=extract_tuner.high)
+        copy_pool = ThreadPoolExecutor(max_workers=copy_tuner.high)
+        try:
+            with extract_pool, copy_pool:
+                try:
+                    for group, prefetched in groups:
+                        progress.update(len(group))
+                        window.acquire()
+                        futures.append(extract_pool.submit(find, group, prefetched))
+                        collect(wait=False)
+                    collect(wait=True)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            for tuner in tuners:
+                self.stats[f"autotune_{tuner.name}_workers"] = tuner.workers
+                self.count(f"autotune_{tuner.name}_changes", len(tuner.decisions))
+                for old, new, rate, latency in tuner.decisions:
+                    self.log["autotune"].append(
+                        (tuner.name, old, new, round(rate, 1), round(latency, 4))
+                    )
 
-        :param src_file: Source path.
-        :param dest_file: Destination path.
+    def move_group(
+        self, group, dest_path, prefix, file_timestamp, move=False, dryrun=False
+    ):
+        """Move or copy the files of one capture under the same destination name.
+
+        If any member collides with a different file, every member gets the next
+        free `-N` index so they keep sharing a name.
+
+        :param group: list of source paths.
+        :param dest_path: Destination root.
+        :param prefix: File name prefix.
+        :param file_timestamp: Timestamp of the capture.
         :param move: True to move files, False to copy them.
         :param dryrun: If True then files will not be copied or moved.
-        :return: None
+        :return: list of the sources that are now in the destination.
         """
 
-        src = Path(src_file)
-        dest = Path(dest_file)
+        dests = [
+            self.get_destination(
+                dest_path, prefix, file_timestamp, x.suffix, self.layout
+            )
+            for x in group
+        ]
 
-        if not self.is_file(src):
-            return False
-        if dest.exists():
-            if not self.is_file(dest):
-                return False
-            elif not dryrun:
-                index = 1
-                stem = dest.stem
-                suffix = dest.suffix
-                while dest.exists() and not self.diff_files(src, dest):
-                    dest = dest.parent / ("%s-%d%s" % (stem, index, suffix))
-                    index += 1
+        index = 0
+        while len(group) > 1 and not dryrun:
+            candidates = [self.destination_name(x, index) for x in dests]
+            if all(
+                self.free_or_same(src, dest) for src, dest in zip(group, candidates)
+            ):
+                break
+            index += 1
 
-        if dryrun:
-            self.log["processed"].append(f"{src} -> {dest}")
-            return True
+        done = list()
+        for src, dest in zip(group, dests):
+            if self.move_file(src, dest, move, dryrun, index):
+                done.append(src)
+            else:
+                self.log["collisions"].append((src, self.destination_name(dest, index)))
+        return done
 
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        if move:
-            shutil.move(src, dest)
-        else:
-            shutil.copy2(src, dest)
+    def free_or_same(self, src, dest):
+        """Check whether a destination name is free or holds the same data as a source.
 
-        return True
+        :param src: Source path.
+        :param dest: Destination path.
+        :return: bool
+        """
+
+        if self.storage is not None:
+            return self.stored_file(
+                dest, src.stat().st_size, lambda: self.hash_file(src)
+            ) in (None, True)
+        return not dest.exists() or (self.is_file(dest) and self.diff_files(src, dest))
+
+    def sort_archive(
+        self, src_path, dest_path, exif=False, google_json_date=False, dryrun=False
+    ):
+        """Sort the members of an archive into the destination path.
+
+        Members are read straight from the archive, nothing is extracted to disk.
+
+        :param src_path: Path of the zip or tar archive.
+        :param dest_path: Path to write files to.
+        :param exif: True to look for exif data to get datetime stamp.
+        :param google_json_date: True to look for Google JSON files with image data.
+        :param dryrun: If True then copy will be skipped.
+        :return:
+        """
+
+        excluded = dict()
+
+        def is_excluded(path, directory):
+            # Each directory is only checked once, like the pruned walk of a directory
+            if path not in excluded:
+                parent = path.rsplit("/", 1)[0] if "/" in path else None
+                excluded[path] = (
+                    parent is not None and is_excluded(parent, True)
+                ) or self.is_excluded(path, directory)
+            return excluded[path]
+
+        with Archive(src_path) as archive:
+            for name in tqdm(archive.names()):
+                member = PurePosixPath(name)
+                if is_excluded(member.as_posix(), False):
+                    continue
+                if not self.in_shard(member):
+                    self.count("shard_skipped")
+                    continue
+                self.count("files")
+
+                prefix = self.get_prefix(member)
+                if prefix is None:
+                    self.log["suffix"].append(archive.path / name)
+                    continue
+
+                d = self.get_date([member], exif, google_json_date, archive)
+                if d is None:
+                    continue
+
+                dest = self.get_destination(
+                    dest_path, prefix, d, member.suffix, self.layout
+                )
+                if not self.move_member(archive, name, dest, dryrun):
+                    self.log["collisions"].append((archive.path / name, dest))
 
     def sort_images(
         self,
@@ -330,66 +4589,87 @@ class SortingPictures:
         :return:
         """
 
-        def process_file(file_timestamp):
-            dest = (
-                dest_path
-                / file_timestamp.strftime("%Y-%m")
-                / (
-                    prefix
-                    + file_timestamp.strftime("%Y%m%d_%H%M%S")
-                    + src.suffix.lower()
-                )
-            )
-
-            if not self.move_file(src, dest, move, dryrun):
-                self.log["collisions"].append((src, dest))
+        if Archive.is_archive(src_path):
+            # Archive members are always copied, they can't be removed from the archive
+            self.sort_archive(src_path, dest_path, exif, google_json_date, dryrun)
+            self.commit()
+            self.finish_thumbnails()
+            return
 
-        for src in tqdm(self.search_directory(src_path)):
-            if src.is_dir():
+        previous = current = None
+        if self.snapshot is not None:
+            settings = self.snapshot_settings(dest_path, exif, google_json_date)
+            previous, current = self.load_snapshot(src_path, settings), dict()
+            failed = {key: len(self.log[key]) for key in self.snapshot_failures}
+        with self.span("scan", "scan", path=None, source=str(src_path)) as args:
+            table = self.scan_directory(src_path, previous, current)
+            args["files"] = len(table)
+        images = array.array("I")
+        videos = array.array("I")
+        for row in range(len(table)):
+            if self.shard is not None and not self.in_shard(table.path(row), src_path):
+                self.count("shard_skipped")
                 continue
+            self.count("files")
 
-            if src.suffix.lower() in {
-                ".dng",
-                ".jpg",
-                ".jpeg",
-                ".gif",
-                ".png",
-                ".nef",
-                ".xmp",
-            }:
-                prefix = "IMG_"
-            elif src.suffix.lower() in {".mp4", ".mov"}:
-                prefix = "VID_"
+            suffix = table.suffix(row).lower()
+            if suffix in self.image_suffixes:
+                images.append(row)
+            elif suffix in self.video_suffixes:
+                videos.append(row)
             else:
-                self.log["suffix"].append(src)
-                continue
+                self.log["suffix"].append(table.path(row))
 
-            if exif:
-                d = self.get_date_from_exif(src)
-                if d is None:
-                    d = self.get_date_from_xmp(src)
-                if d is None:
-                    d = self.get_date_from_video(src)
-                if d is not None:
-                    process_file(d)
-                    continue
-                else:
-                    self.log["exif"].append(src)
+        def captures():
+            # Files of a directory are next to each other, so only one directory
+            # at a time has to be grouped
+            for _, rows in itertools.groupby(images, key=table.parents.__getitem__):
+                for group in self.group_files(rows, table):
+                    yield [table.path(x) for x in group]
+            for row in videos:
+                yield [table.path(row)]
 
-            if google_json_date:
-                d = self.get_google_json_date(src)
-                if d is not None:
-                    process_file(d)
-                    continue
-                else:
-                    self.log["google_json_date"].append(src)
+        def extract(group, prefetched):
+            fingerprints = self.check_ledger(group)
+            if fingerprints is None:
+                return None
+            d = self.get_date(group, exif, google_json_date, prefetched=prefetched)
+            if d is None:
+                return None
+            return fingerprints, d
 
-            d = self.get_date_from_filename(src.name)
-            if d is not None:
-                process_file(d)
-                continue
+        def store(group, fingerprints, d):
+            prefix = self.get_prefix(group[0])
+            done = self.move_group(group, dest_path, prefix, d, move, dryrun)
+            if self.ledger is not None and not dryrun:
+                for src in done:
+                    if fingerprints[src][0] is not None:
+                        self.ledger.add(*fingerprints[src], src)
+                        self.count("ledger_recorded")
+
+        with tqdm(total=len(images) + len(videos), unit="file") as progress:
+            groups = self.prefetch_groups(captures(), exif, google_json_date)
+            if self.autotune:
+                self.run_stages(groups, extract, store, progress)
             else:
-                self.log["parse"].append(src)
+                for group, prefetched in groups:
+                    progress.update(len(group))
+                    found = extract(group, prefetched)
+                    if found is not None:
+                        store(group, *found)
+
+        self.commit()
+        self.finish_thumbnails()
+        if current is not None and not dryrun:
+            # Only once every file found has been sorted
+            for key, start in failed.items():
+                for entry in self.log[key][start:]:
+                    path = entry[0] if isinstance(entry, tuple) else entry
+                    relative = os.path.relpath(Path(path).parent, src_path)
+                    relative = "" if relative == "." else relative + "/"
+                    if relative in current:
+                        current[relative] = (None,) + tuple(current[relative][1:])
+            self.save_snapshot(src_path, current, settings)
 
     def main(self):
         """Main method to be called by CLI.
@@ -399,6 +4679,112 @@ class SortingPictures:
 
         parser = self.parse_arguments()
         args = parser.parse_args()
+
+        if args.trace:
+            self.tracer = Tracer()
+        if args.profile:
+            self.profiler = Profiler()
+            self.profiler.start()
+        try:
+            self.run(parser, args)
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler.write(args.profile)
+            if self.tracer is not None:
+                self.tracer.write(args.trace)
+
+    def run(self, parser, args):
+        """Carry out what was asked for on the command line.
+
+        :param parser: Argument parser, for printing the help.
+        :param args: Parsed command line arguments.
+        :return: None
+        """
+
+        if args.merge_reports:
+            for report in args.paths:
+                self.load_report(report)
+            self.print_log(args)
+            if args.report:
+                self.write_report(args.report)
+            return
+
+        if args.shard:
+            match = re.fullmatch(r"(\d+)/(\d+)", args.shard)
+            if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+                print("--shard must be I/N with 1 <= I <= N, for example 1/4.")
+                sys.exit(1)
+            self.shard = (int(match.group(1)), int(match.group(2)))
+
+        for name in ("extract_workers", "copy_workers"):
+            match = re.fullmatch(r"(\d+):(\d+)", getattr(args, name))
+            if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+                option = "--" + name.replace("_", "-")
+                print(
+                    f"{option} must be MIN:MAX with 1 <= MIN <= MAX, for example 1:8."
+                )
+                sys.exit(1)
+            setattr(self, name, (int(match.group(1)), int(match.group(2))))
+        self.autotune = args.autotune
+
+        self.workers = args.workers
+        self.durability = args.durability
+        self.sync_files = args.sync_files
+        self.sync_bytes = args.sync_bytes
+        self.set_limits(args.read_limit, args.write_limit, args.ops_limit)
+        if args.limits_file:
+            self.watch_limits(args.limits_file)
+        self.hash_algorithm = args.hash
+
+        if args.verify:
+            for dest_path in args.paths:
+                self.verify_library(dest_path, args.checkpoint)
+            self.print_log(args)
+            if args.report:
+                self.write_report(args.report)
+            return
+
+        for layout in (args.layout, args.relayout):
+            try:
+                if layout is not None:
+                    self.check_layout(layout)
+            except ValueError:
+                print(
+                    "--layout and --relayout need a strftime format such as %Y/%Y-%m."
+                )
+                sys.exit(1)
+
+        if args.relayout:
+            for dest_path in args.paths:
+                self.relayout_library(dest_path, args.relayout, args.dryrun)
+                if self.catalog is not None:
+                    self.catalog.close()
+                    self.catalog = None
+            self.print_log(args)
+            if args.report:
+                self.write_report(args.report)
+            return
+
+        if args.query:
+            if args.query != "months":
+                try:
+                    self.parse_range(args.query)
+                except ValueError:
+                    print("--query must be months or a range such as 2019-03..2019-06.")
+                    sys.exit(1)
+            for dest_path in args.paths:
+                self.query_catalog(dest_path, args.query)
+            return
+
+        if args.compact:
+            for dest_path in args.paths:
+                self.compact_library(dest_path, args.dryrun)
+            self.print_log(args)
+            if args.report:
+                self.write_report(args.report)
+            return
+
         if len(args.paths) < 2:
             parser.print_help()
             sys.exit(1)
@@ -412,19 +4798,71 @@ class SortingPictures:
             parser.print_help()
             sys.exit(1)
 
-        dest_path = Path(args.paths[-1])
+        self.shard_by = args.shard_by
+        self.manifest = args.manifest
+        self.verify_copy = args.verify_copy
+        self.extractor_timeout = args.extractor_timeout
+        self.prefetch = args.prefetch
+        self.snapshot = args.snapshot
+        if args.rules_file:
+            with open(args.rules_file) as in_file:
+                for line in in_file:
+                    self.rules.add(line)
+        for rule in args.rules or list():
+            self.rules.add(rule)
+        self.thumbnails = args.thumbnails
+        self.thumbnail_size = args.thumbnail_size
 
-        for src_path in [Path(p) for p in args.paths[:-1]]:
-            self.sort_images(
-                src_path,
-                dest_path,
-                move=args.move,
-                exif=args.exif,
-                google_json_date=args.google_json,
-                dryrun=args.dryrun,
+        dest_path = Path(args.paths[-1])
+        self.layout = args.layout or self.read_layout(dest_path) or self.layout
+        if args.catalog and not args.paths[-1].startswith("s3://"):
+            self.open_catalog(dest_path)
+        if args.ledger:
+            self.ledger = Ledger(args.ledger)
+            self.reimport = args.reimport
+        if args.paths[-1].startswith("s3://"):
+            self.storage = ObjectStorage.from_url(
+                args.paths[-1],
+                args.endpoint,
+                part_size=args.part_size,
+                workers=args.workers,
             )
+            # Keys are relative to the bucket prefix
+            dest_path = Path()
+
+        try:
+            for src_path in [Path(p) for p in args.paths[:-1]]:
+                self.sort_images(
+                    src_path,
+                    dest_path,
+                    move=args.move,
+                    exif=args.exif,
+                    google_json_date=args.google_json,
+                    dryrun=args.dryrun,
+                )
+        finally:
+            # Sources already copied are only deleted once their copies are safe
+            self.commit()
+            if self.catalog is not None:
+                self.catalog.close()
+            if self.ledger is not None:
+                self.count("ledger_false_positives", self.ledger.false_positives)
+                self.ledger.close()
+            if self.thumbnail_pool is not None:
+                self.thumbnail_pool.shutdown(cancel_futures=True)
+
+        self.print_log(args)
+        if args.report:
+            self.write_report(args.report)
+
+    def print_log(self, args):
+        """Print the parts of the log asked for on the command line.
+
+        :param args: Parsed command line arguments.
+        :return: None
+        """
 
-        if args.dryrun:
+        if args.dryrun and not args.compact:
             print("processed", len(self.log["processed"]))
 
         if args.collisions:
@@ -433,6 +4871,8 @@ class SortingPictures:
         if args.exif:
             for s in self.log["exif"]:
                 print("exif", s)
+            for s in self.log["timeout"]:
+                print("timeout", s)
         if args.suffix:
             for s in self.log["suffix"]:
                 print("suffix", s)
@@ -442,6 +4882,61 @@ class SortingPictures:
         if args.google_json:
             for s in self.log["google_json_date"]:
                 print("google_json_date", s)
+        if args.verify_copy:
+            for s, d in self.log["verify"]:
+                print("verify", s, d)
+        if args.verify:
+            for key in "bitrot missing unexpected".split():
+                for s in self.log[key]:
+                    print(key, s)
+        if args.compact:
+            for s, d in self.log["compact"]:
+                print("compact", s, d)
+            verb = "reclaimable" if args.dryrun else "reclaimed"
+            print(verb, self.stats["compact_bytes"])
+        if args.verify or args.compact or args.catalog:
+            for s in self.log["partials"]:
+                print("partials", s)
+        if args.stats:
+            for key, value in sorted(self.stats.items()):
+                print("stats", key, value)
+            for stage, old, new, rate, latency in self.log["autotune"]:
+                print(
+                    "autotune", stage, old, "->", new, "rate", rate, "latency", latency
+                )
+
+    def write_report(self, report):
+        """Write the log and stats to a JSON report.
+
+        :param report: Path of the report file.
+        :return: None
+        """
+
+        log = dict()
+        for key, entries in self.log.items():
+            log[key] = [
+                [str(x) for x in entry] if isinstance(entry, tuple) else str(entry)
+                for entry in entries
+            ]
+
+        with open(report, "w") as out_file:
+            json.dump({"log": log, "stats": self.stats}, out_file, indent=2)
+
+    def load_report(self, report):
+        """Add the log and stats from a JSON report to this run's.
+
+        :param report: Path of the report file.
+        :return: None
+        """
+
+        with open(report) as in_file:
+            data = json.load(in_file)
+
+        for key, entries in data["log"].items():
+            self.log.setdefault(key, list()).extend(
+                tuple(entry) if isinstance(entry, list) else entry for entry in entries
+            )
+        self.stats.update(data["stats"])
 
 
 if __name__ == "__main__":